@@ -0,0 +1,276 @@
+"""
+Drives `keep_updated` of both marketplace cogs against the mock marketplaces with synthetic queries,
+Discord is replaced by fake guild and threads that only record what was sent. Run from the repository root:
+
+    python -m bench.load_harness --queries 2000 --duration 120 --rate 5 --output load_results.json
+
+Reports cycle time, announce latency (listing created -> message sent), requests per listing and memory.
+"""
+import argparse
+import asyncio
+import json
+import resource
+import tracemalloc
+
+from collections import defaultdict
+from random import Random
+from statistics import quantiles
+from tempfile import TemporaryDirectory
+from time import monotonic, time
+from config import Config
+from bench.mock_market import MockMarket
+
+
+def summary(samples, digits=3):
+    if not samples:
+        return {'count' : 0}
+    if len(samples) == 1:
+        p50 = p95 = p99 = samples[0]
+    else:
+        cuts = quantiles(samples, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    return {'count' : len(samples), 'p50' : round(p50, digits), 'p95' : round(p95, digits), 'p99' : round(p99, digits), 'max' : round(max(samples), digits)}
+
+
+class FakeMessage:
+    def __init__(self, id, channel):
+        self.id = id
+        self.channel = channel
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class FakeThread:
+    """Records every send with the latency since the announced listing was created on the mock market"""
+    def __init__(self, id, harness):
+        self.id = id
+        self.name = f'thread-{id}'
+        self.jump_url = f'https://discord.com/channels/0/{id}'
+        self.harness = harness
+        self.sent = 0
+
+    async def send(self, content=None, embed=None, **kwargs):
+        self.sent += 1
+        self.harness.record_send(self, embed)
+        return FakeMessage(self.sent, self)
+
+    async def delete(self):
+        pass
+
+
+class FakeGuild:
+    def __init__(self, threads):
+        self.threads = threads
+
+    def get_channel_or_thread(self, id):
+        return self.threads.get(id)
+
+
+class FakeTree:
+    def add_command(self, *args, **kwargs):
+        pass
+
+    def remove_command(self, *args, **kwargs):
+        pass
+
+
+class FakeBot:
+    def __init__(self):
+        self.tree = FakeTree()
+        self.user = None
+
+    async def wait_until_ready(self):
+        pass
+
+
+class Harness:
+    def __init__(self, market):
+        self.market = market
+        self.latency = defaultdict(list) # marketplace : [seconds]
+        self.announced = defaultdict(set)
+        self.threads = {}
+        self.thread_marketplace = {}
+        self.cycles = defaultdict(list)
+        self.cycle_started = {}
+
+    def add_thread(self, id, marketplace):
+        self.threads[id] = FakeThread(id, self)
+        self.thread_marketplace[id] = marketplace
+        return self.threads[id]
+
+    def record_send(self, thread, embed):
+        marketplace = self.thread_marketplace[thread.id]
+        id = str(embed.url).rstrip('/').split('/')[-1] if embed else None
+        listing = self.market.listings.get(id)
+        if listing:
+            self.latency[marketplace].append(time() - listing.created_at)
+            self.announced[marketplace].add(id)
+
+    def timed(self, marketplace, coro_fn):
+        """Wraps a cog coroutine so every run of it is recorded as one cycle"""
+        async def run(*args, **kwargs):
+            started = monotonic()
+            try:
+                return await coro_fn(*args, **kwargs)
+            finally:
+                self.cycles[marketplace].append(monotonic() - started)
+        return run
+
+    def starts_cycle(self, marketplace, fn):
+        def run(*args, **kwargs):
+            self.cycle_started[marketplace] = monotonic()
+            return fn(*args, **kwargs)
+        return run
+
+    def ends_cycle(self, marketplace, coro_fn):
+        async def run(*args, **kwargs):
+            try:
+                return await coro_fn(*args, **kwargs)
+            finally:
+                if marketplace in self.cycle_started:
+                    self.cycles[marketplace].append(monotonic() - self.cycle_started.pop(marketplace))
+        return run
+
+
+def make_queries(random, vocabulary, count):
+    queries = []
+    for _ in range(count):
+        low = random.choice([0, 0, 50, 100, 200])
+        high = random.choice([0, 300, 500, 800]) or 1000
+        queries.append((random.choice(vocabulary), low, high))
+    return queries
+
+
+async def run(args):
+    from cogs.parsers.http import LimitedSession, PoolStats, make_session
+    from cogs.parsers.rate_limit import HostLimiters
+    from cogs.ebay_commands import SmolEbayCommands
+    from cogs.big_ebay_commands import BigEbayCommands
+
+    market = MockMarket(args.rate, args.vocabulary, seed=args.seed, latency=args.latency)
+    await market.start()
+    harness = Harness(market)
+    random = Random(args.seed)
+    limiters = HostLimiters({}, default=(args.host_rate, args.host_rate))
+
+    sessions = []
+    for _ in range(2):
+        pool = PoolStats()
+        sessions.append((make_session(pool, limit=args.connections, limit_per_host=args.connections), pool))
+
+    bot = FakeBot()
+    smol = SmolEbayCommands(bot)
+    big = BigEbayCommands(bot)
+
+    smol_count = args.queries // 2
+    for idx, (word, low, high) in enumerate(make_queries(random, market.vocabulary, smol_count)):
+        thread = harness.add_thread(1000000 + idx, 'kleinanzeigen')
+        smol.queries[thread.id] = {'name' : thread.name, 'kwargs' : [{'query' : word, 'minPrice' : low, 'maxPrice' : high, 'exclude' : ''}], 'jump_url' : thread.jump_url}
+    big_queries = make_queries(random, market.vocabulary, args.queries - smol_count)
+
+    smol._set_essentials(LimitedSession(sessions[0][0], limiters, sessions[0][1]))
+    big._set_essentials(LimitedSession(sessions[1][0], limiters, sessions[1][1]))
+    smol.parser.base_uri = market.kleinanzeigen_uri
+    big.parser.base_uri = market.ebay_uri
+    for idx, (word, low, high) in enumerate(big_queries):
+        thread = harness.add_thread(2000000 + idx, 'ebay')
+        big.queries[thread.id] = {
+            'name' : thread.name,
+            'params' : big.parser.get_params(query=word, minPrice=low, maxPrice=high),
+            'jump_url' : thread.jump_url,
+            'firstTime' : False,
+            'mention' : '',
+            'interval' : args.interval,
+            'jitter' : 0.2,
+        }
+    # A Kleinanzeigen cycle runs from planning all searches to saving, eBay runs one update per merged search
+    smol.planner.plan = harness.starts_cycle('kleinanzeigen', smol.planner.plan)
+    smol.parser.save_ads_to_file = harness.ends_cycle('kleinanzeigen', smol.parser.save_ads_to_file)
+    big.scheduler.callback = harness.timed('ebay', big.scheduler.callback)
+
+    guild = FakeGuild(harness.threads)
+    smol.set_guild(guild)
+    big.set_guild(guild)
+    print(f'Running {smol_count} Kleinanzeigen and {len(big_queries)} eBay queries for {args.duration}s against {market.base_url}')
+    started = monotonic()
+    await asyncio.sleep(args.duration)
+    elapsed = monotonic() - started
+
+    traced = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+    for cog in (smol, big):
+        cog.worker.cancel()
+    for task in smol.parser.detail_workers:
+        task.cancel()
+    for session, _ in sessions:
+        await session.close()
+    await market.stop()
+
+    report = {
+        'created' : int(time()),
+        'args' : vars(args),
+        'elapsed' : round(elapsed, 1),
+        'memory' : {
+            'max_rss_mib' : round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'traced_peak_mib' : round(traced / 1024 / 1024, 1) if traced else None,
+        },
+        'host_limiters' : limiters.stats(),
+    }
+    for marketplace, cog in (('kleinanzeigen', smol), ('ebay', big)):
+        requests = {endpoint : n for (m, endpoint), n in market.requests.items() if m == marketplace}
+        total = sum(requests.values())
+        generated = market.generated[marketplace]
+        announced = len(harness.announced[marketplace])
+        report[marketplace] = {
+            'queries' : len([x for x in harness.thread_marketplace.values() if x == marketplace]),
+            'cycle_seconds' : summary(harness.cycles[marketplace]),
+            'announce_latency_seconds' : summary(harness.latency[marketplace]),
+            'messages' : len(harness.latency[marketplace]),
+            'listings_generated' : generated,
+            'listings_announced' : announced,
+            'requests' : requests,
+            'requests_per_listing' : round(total / generated, 2) if generated else None,
+            'requests_per_announced' : round(total / announced, 2) if announced else None,
+            'cache' : cog.parser.cached_ads.stats(),
+            'freshness' : {stage : cog.freshness.percentiles(stage) for stage in ('detected', 'sent', 'total')},
+        }
+    return report
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Load harness for the marketplace cogs')
+    arg_parser.add_argument('--queries', type=int, default=2000, help='Synthetic queries, split evenly between marketplaces')
+    arg_parser.add_argument('--duration', type=float, default=120, help='Seconds to run')
+    arg_parser.add_argument('--rate', type=float, default=5, help='New listings per second and marketplace')
+    arg_parser.add_argument('--vocabulary', type=int, default=200, help='Distinct query words, fewer means more overlapping queries')
+    arg_parser.add_argument('--interval', type=int, default=20, help='Polling interval for both marketplaces in seconds')
+    arg_parser.add_argument('--latency', type=float, default=0, help='Seconds added to every mock response')
+    arg_parser.add_argument('--host-rate', type=float, default=1000, help='Client side requests per second budget for the mock host')
+    arg_parser.add_argument('--connections', type=int, default=20, help='Connection pool size per marketplace')
+    arg_parser.add_argument('--detail-rate', type=float, default=50, help='Kleinanzeigen details requests per second')
+    arg_parser.add_argument('--tracemalloc', action='store_true', help='Trace Python allocations, slows everything down')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--output', default='load_results.json')
+    args = arg_parser.parse_args()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    with TemporaryDirectory() as cache_path:
+        Config.CACHE_PATH = cache_path
+        Config.SMOL_EBAY_UPDATE_INTERVAL = args.interval
+        Config.EBAY_UPDATE_INTERVAL = args.interval
+        Config.SMOL_EBAY_DETAIL_RATE = args.detail_rate
+        Config.SMOL_EBAY_DETAIL_BURST = max(1, int(args.detail_rate))
+        report = asyncio.run(run(args))
+    with open(args.output, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2)
+    for marketplace in ('kleinanzeigen', 'ebay'):
+        x = report[marketplace]
+        print(f"{marketplace}: {x['queries']} queries, cycle {x['cycle_seconds']}, announce latency {x['announce_latency_seconds']}, "
+              f"{x['requests_per_listing']} requests/listing, {x['listings_announced']}/{x['listings_generated']} listings announced")
+    print(f"memory: {report['memory']}")
+    print(f'Wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
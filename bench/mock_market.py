@@ -0,0 +1,249 @@
+"""
+Local stand-in for the Kleinanzeigen and eBay endpoints the parsers use. New listings are generated
+at a fixed rate with titles made of `word{n}` tokens, searches return the newest listings containing the query.
+
+    python -m bench.mock_market --port 8080 --rate 5 --vocabulary 200
+
+Point the parsers at it by overriding their `base_uri`, see `MockMarket.kleinanzeigen_uri` and `ebay_uri`.
+"""
+import argparse
+import asyncio
+
+from collections import Counter, defaultdict, deque
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from random import Random
+from time import time
+from aiohttp import web
+
+KLEINANZEIGEN_ADS = '{http://www.ebayclassifiedsgroup.com/schema/ad/v1}ads'
+KLEINANZEIGEN_AD = '{http://www.ebayclassifiedsgroup.com/schema/ad/v1}ad'
+
+
+def date_string(ts, fmt):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime(fmt)
+
+
+class MockListing:
+    __slots__ = ('id', 'title', 'words', 'price', 'created_at', 'auction')
+
+    def __init__(self, id, title, words, price, created_at, auction):
+        self.id = id
+        self.title = title
+        self.words = words
+        self.price = price
+        self.created_at = created_at
+        self.auction = auction
+
+
+class MockMarket:
+    """
+    Generates listings for both marketplaces and serves them through an aiohttp application.
+    `listings` maps every generated id to its listing so harnesses can measure announce latency.
+    """
+    def __init__(self, rate=5, vocabulary=200, words_per_title=3, keep=500, seed=0, latency=0):
+        self.rate = rate
+        self.vocabulary = [f'word{i}' for i in range(vocabulary)]
+        self.words_per_title = words_per_title
+        self.keep = keep
+        self.latency = latency
+        self.random = Random(seed)
+        self.ids = count(1)
+        self.listings = {} # id : MockListing, both marketplaces
+        self.by_word = {name : defaultdict(lambda: deque(maxlen=keep)) for name in ('kleinanzeigen', 'ebay')}
+        self.generated = Counter()
+        self.requests = Counter() # (marketplace, endpoint) : count
+        self.base_url = None
+        self._generator = None
+        self._runner = None
+
+    @property
+    def kleinanzeigen_uri(self):
+        return f'{self.base_url}/api/'
+
+    @property
+    def ebay_uri(self):
+        return f'{self.base_url}/experience/'
+
+    def create_listing(self, marketplace):
+        words = self.random.sample(self.vocabulary, self.words_per_title)
+        n = next(self.ids)
+        id = str(3000000000 + n) if marketplace == 'kleinanzeigen' else str(400000000000 + n)
+        listing = MockListing(id, f"{' '.join(words)} #{n}", words, self.random.randint(5, 1000), time(), self.random.random() < 0.3)
+        self.listings[id] = listing
+        for word in words:
+            self.by_word[marketplace][word].appendleft(listing)
+        self.generated[marketplace] += 1
+        return listing
+
+    async def generate(self):
+        # Both marketplaces get `rate` new listings per second
+        while True:
+            for marketplace in self.by_word:
+                self.create_listing(marketplace)
+            await asyncio.sleep(1 / self.rate)
+
+    def search(self, marketplace, query, low=None, high=None, size=30):
+        query = (query or '').lower()
+        words = query.split()
+        candidates = self.by_word[marketplace].get(words[0], ()) if words else ()
+        found = []
+        for listing in candidates:
+            if query in listing.title and (low is None or listing.price >= low) and (high is None or listing.price <= high):
+                found.append(listing)
+                if len(found) >= size:
+                    break
+        return found
+
+    def app(self):
+        app = web.Application(middlewares=[self.count_requests])
+        app.router.add_get('/api/ads.json', self.kleinanzeigen_search)
+        app.router.add_get('/api/ads/{id}.json', self.kleinanzeigen_details)
+        app.router.add_post('/api/v2/counters/ads/vip/{id}', self.kleinanzeigen_counter)
+        app.router.add_get('/experience/search/v1/search_results', self.ebay_search)
+        app.router.add_get('/experience/listing_details/v2/view_item', self.ebay_details)
+        app.router.add_post('/experience/auction/v2/bid/module_provider/commit_bid', self.ebay_bid)
+        return app
+
+    @web.middleware
+    async def count_requests(self, request, handler):
+        marketplace = 'kleinanzeigen' if request.path.startswith('/api/') else 'ebay'
+        self.requests[(marketplace, request.match_info.route.resource.canonical if request.match_info.route.resource else request.path)] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://{host}:{port}'
+        self._generator = asyncio.create_task(self.generate())
+        return self.base_url
+
+    async def stop(self):
+        if self._generator:
+            self._generator.cancel()
+        if self._runner:
+            await self._runner.cleanup()
+
+    # Kleinanzeigen
+    def kleinanzeigen_ad(self, listing):
+        return {
+            'id' : listing.id,
+            'price' : {'amount' : {'value' : listing.price}, 'price-type' : {'value' : 'SPECIFIED_AMOUNT'}},
+            'title' : {'value' : listing.title},
+            'locations' : {'location' : [{'id' : '3331', 'regions' : {'region' : [{'localized-name' : {'value' : 'Berlin'}}]}}]},
+            'ad-address' : {'state' : {'value' : 'Berlin'}, 'zip-code' : {'value' : '10249'}},
+            'ad-status' : {'value' : 'ACTIVE'},
+            'start-date-time' : {'value' : date_string(listing.created_at, '%Y-%m-%dT%H:%M:%S.000+0000')},
+            'attributes' : {'attribute' : [{'localized-tag' : 'Versand möglich'}]},
+            'displayoptions' : {'secure-payment-possible' : {'value' : 'true'}},
+            'link' : [{'href' : f'{self.kleinanzeigen_uri}ads/{listing.id}'}, {'href' : f'https://www.kleinanzeigen.de/s-anzeige/{listing.id}'}],
+            'pictures' : {'picture' : [{'link' : [{}, {}, {'href' : f'https://img.kleinanzeigen.de/{listing.id}.jpg'}]}]},
+        }
+
+    async def kleinanzeigen_search(self, request):
+        q = request.query
+        found = self.search('kleinanzeigen', q.get('q'), float(q['minPrice']) if 'minPrice' in q else None, float(q['maxPrice']) if 'maxPrice' in q else None, int(q.get('size', 30)))
+        return web.json_response({'searchOptions' : {}, KLEINANZEIGEN_ADS : {'value' : {'ad' : [self.kleinanzeigen_ad(x) for x in found]}}})
+
+    async def kleinanzeigen_details(self, request):
+        listing = self.listings.get(request.match_info['id'])
+        if not listing:
+            return web.json_response({}, status=404)
+        return web.json_response({KLEINANZEIGEN_AD : {'value' : {
+            'id' : listing.id,
+            'description' : {'value' : f'Mock listing {listing.title}<br />Zweite Zeile'},
+            'contact-name' : {'value' : 'Mock'},
+            'user-id' : {'value' : '51234567'},
+            'user-rating' : {'averageRating' : {'value' : 1.5}},
+            'user-since-date-time' : {'value' : '2014-05-02T10:11:12.000+0200'},
+        }}})
+
+    async def kleinanzeigen_counter(self, request):
+        return web.json_response({'value' : self.random.randint(0, 500)})
+
+    # eBay
+    def ebay_item(self, listing):
+        props = [['__search.sellerInfo'], ['displayPrice'], ['__search.freeXDays']]
+        item = {
+            'listingId' : listing.id,
+            'action' : {'trackingList' : [{'eventProperty' : {'sid' : 'p2351460.m4114.l7400'}}]},
+            'title' : {'textSpans' : [{'text' : listing.title}]},
+            'displayPrice' : {'value' : {'value' : listing.price, 'currency' : 'EUR'}},
+            '__search' : {
+                'sellerInfo' : {'text' : {'textSpans' : [{'text' : 'mock_seller (100) 100%'}]}},
+                'normalizedCondition' : {'text' : 'Gebraucht'},
+                'sellerAccountType' : {'text' : 'Privat'},
+            },
+            'image' : {'URL' : f'https://i.ebayimg.com/images/g/{listing.id}/s-l500.jpg'},
+        }
+        if listing.auction:
+            props += [['bidCount'], ['displayTime']]
+            item['displayTime'] = {'value' : {'value' : date_string(listing.created_at + 7*24*60*60, '%Y-%m-%dT%H:%M:%S.000Z')}}
+        item['itemPropertyOrdering'] = {'DEFAULT' : {'primary' : props}}
+        return item
+
+    async def ebay_search(self, request):
+        q = request.query
+        found = self.search('ebay', q.get('_nkw'), float(q['_udlo']) if '_udlo' in q else None, float(q['_udhi']) if '_udhi' in q else None)
+        modules = {f'listing_{idx}' : self.ebay_item(x) for idx, x in enumerate(found)}
+        return web.json_response({'modules' : modules})
+
+    async def ebay_details(self, request):
+        listing = self.listings.get(request.query.get('itemId', ''))
+        if not listing:
+            return web.json_response({}, status=404)
+        start = datetime.fromtimestamp(listing.created_at, timezone.utc)
+        return web.json_response({'modules' : {
+            'VLS' : {'listing' : {
+                'listingLifecycle' : {
+                    'scheduledStartDate' : {'value' : start.strftime('%Y-%m-%dT%H:%M:%SZ')},
+                    'scheduledEndDate' : {'value' : (start + timedelta(days=7)).strftime('%Y-%m-%dT%H:%M:%SZ')},
+                },
+                'format' : 'AUCTION' if listing.auction else 'FIXED_PRICE',
+                'title' : {'content' : listing.title},
+            }},
+            'SEMANTIC_DATA' : {'bidPrefetch' : {'tracking' : {'eventProperty' : {'sid' : 'p2047675.l1473'}}}},
+        }})
+
+    async def ebay_bid(self, request):
+        payload = await request.json()
+        return web.json_response({'modules' : {'AUCTION_META' : {
+            'isHighBidder' : True,
+            'currentPrice' : {'value' : payload['price']['value']},
+            'highBidder' : {'name' : 'mock'},
+        }}})
+
+
+async def serve(args):
+    market = MockMarket(args.rate, args.vocabulary, seed=args.seed, latency=args.latency)
+    url = await market.start(args.host, args.port)
+    print(f'Mock marketplaces on {url}, Kleinanzeigen {market.kleinanzeigen_uri}, eBay {market.ebay_uri}')
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(f'Generated {dict(market.generated)}, requests {sum(market.requests.values())}')
+    finally:
+        await market.stop()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Mock marketplace server')
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8080)
+    arg_parser.add_argument('--rate', type=float, default=5, help='New listings per second and marketplace')
+    arg_parser.add_argument('--vocabulary', type=int, default=200, help='Distinct words in titles')
+    arg_parser.add_argument('--latency', type=float, default=0, help='Seconds added to every response')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    try:
+        asyncio.run(serve(arg_parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+"""
+Offline benchmarks for the parser entry points, run from the repository root:
+
+    python -m bench.parser_bench --sizes 0 1000 5000 --output bench_results.json
+
+Stored sample responses from bench/fixtures are used as is (size 0) and scaled up to synthetic
+results with thousands of listings. Nothing goes to the network, parsers get a temporary CACHE_PATH.
+Before timing anything it checks that the fixtures decode on the typed path and that a restart
+resumes from the last recorded poll.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import tracemalloc
+
+from copy import deepcopy
+from os import path
+from statistics import quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter, time
+from config import Config
+
+FIXTURES = path.join(path.dirname(__file__), 'fixtures')
+KLEINANZEIGEN_ADS = '{http://www.ebayclassifiedsgroup.com/schema/ad/v1}ads'
+KLEINANZEIGEN_AD = '{http://www.ebayclassifiedsgroup.com/schema/ad/v1}ad'
+
+
+def load_fixture(name):
+    with open(path.join(FIXTURES, name), 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def encode(payload):
+    return json.dumps(payload, ensure_ascii=False).encode('utf8')
+
+
+def scale_kleinanzeigen_search(payload, size):
+    """Search result with `size` listings, sample ads are repeated with unique ids, titles and prices"""
+    payload = deepcopy(payload)
+    if not size:
+        return payload
+    samples = payload[KLEINANZEIGEN_ADS]['value']['ad']
+    ads = []
+    for i in range(size):
+        ad = deepcopy(samples[i % len(samples)])
+        ad['id'] = str(3000000000 + i)
+        ad['title']['value'] = f"{ad['title']['value']} #{i}"
+        if ad['price']['amount'].get('value') is not None:
+            ad['price']['amount']['value'] = 10 + i % 990
+        ads.append(ad)
+    payload[KLEINANZEIGEN_ADS]['value']['ad'] = ads
+    return payload
+
+
+def scale_ebay_search(payload, size):
+    """Search result with `size` listing modules, recommended listings are kept in the mix"""
+    payload = deepcopy(payload)
+    if not size:
+        return payload
+    samples = [v for k, v in payload['modules'].items() if k.startswith('listing')]
+    modules = {k : v for k, v in payload['modules'].items() if not k.startswith('listing')}
+    for i in range(size):
+        item = deepcopy(samples[i % len(samples)])
+        item['listingId'] = str(400000000000 + i)
+        item['title']['textSpans'][0]['text'] = f"{item['title']['textSpans'][0]['text']} #{i}"
+        item['displayPrice']['value']['value'] = 10 + i % 990
+        modules[f'listing_{i}'] = item
+    payload['modules'] = modules
+    return payload
+
+
+class FixtureResponse:
+    def __init__(self, body, status=200):
+        self.body = body
+        self.status = status
+        self.headers = {}
+
+    async def read(self):
+        return self.body
+
+    async def text(self):
+        return self.body.decode('utf8')
+
+    async def json(self):
+        return json.loads(self.body)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FixtureSession:
+    """Answers every request with the stored body of the first route whose key is in the url"""
+    def __init__(self, routes):
+        self.routes = routes
+
+    def _respond(self, url):
+        for key, body in self.routes.items():
+            if key in str(url):
+                return FixtureResponse(body)
+        return FixtureResponse(b'{}', 404)
+
+    def get(self, url, **kwargs):
+        return self._respond(url)
+
+    def post(self, url, **kwargs):
+        return self._respond(url)
+
+
+def percentiles(samples):
+    if len(samples) < 2:
+        value = samples[0] if samples else 0
+        return value, value, value
+    cuts = quantiles(samples, n=100, method='inclusive')
+    return cuts[49], cuts[94], cuts[98]
+
+
+def measure_allocations(run):
+    """Blocks still allocated after one call and peak traced memory during it"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    return {
+        'alloc_blocks' : sum(x.count_diff for x in stats if x.count_diff > 0),
+        'alloc_kib' : round(sum(x.size_diff for x in stats if x.size_diff > 0) / 1024, 1),
+        'peak_kib' : round(peak / 1024, 1),
+    }
+
+
+def bench(name, size, setup, call, repeat, warmup=2):
+    """
+    `setup()` runs untimed before every call and returns its argument, `call(arg)` returns
+    the number of listings it handled
+    """
+    for _ in range(warmup):
+        call(setup())
+    timings = []
+    handled = 0
+    for _ in range(repeat):
+        arg = setup()
+        started = perf_counter()
+        handled += call(arg)
+        timings.append(perf_counter() - started)
+    arg = setup()
+    allocations = measure_allocations(lambda: call(arg))
+    p50, p95, p99 = percentiles(timings)
+    total = sum(timings)
+    return {
+        'name' : name,
+        'size' : size,
+        'calls' : repeat,
+        'listings' : handled,
+        'listings_per_sec' : round(handled / total, 1) if total else None,
+        'p50_ms' : round(p50 * 1000, 3),
+        'p95_ms' : round(p95 * 1000, 3),
+        'p99_ms' : round(p99 * 1000, 3),
+        **allocations,
+    }
+
+
+def run_kleinanzeigen(loop, sizes, repeat):
+    from cogs.parsers.ebay_parser import EbayParser
+    from cogs.parsers.listing_cache import ListingCache
+    from cogs.parsers.rate_limit import TokenBucket
+
+    search = load_fixture('kleinanzeigen_search.json')
+    details = load_fixture('kleinanzeigen_details.json')
+    parser = EbayParser(FixtureSession({'v2/counters/ads/vip/' : encode(load_fixture('kleinanzeigen_counter.json'))}))
+    parser.starting_timestamp = 0
+    parser.enrich = lambda id: None # Details are benchmarked on their own
+    parser.detail_bucket = TokenBucket(1e9, 1e9)
+
+    def fresh_cache():
+        parser.cached_ads = ListingCache(Config.LISTING_CACHE_SIZE, Config.LISTING_CACHE_MAX_AGE)
+
+    results = []
+    for size in sizes:
+        payload = scale_kleinanzeigen_search(search, size)
+        size = len(payload[KLEINANZEIGEN_ADS]['value']['ad'])
+        body = encode(payload)
+
+        def decode_search(body):
+            parser.search_decoder.loads(body)
+            return size
+        results.append(bench('kleinanzeigen.decode_search', size, lambda: body, decode_search, repeat))
+
+        def parse_search(payload):
+            return len(loop.run_until_complete(parser.parse_search_result(payload)))
+        def search_setup():
+            fresh_cache()
+            return parser.search_decoder.loads(body)
+        results.append(bench('kleinanzeigen.parse_search_result', size, search_setup, parse_search, repeat))
+
+    # Details come one listing per response, a batch of them is parsed per call
+    batch = max(sizes) or 1
+    id = details[KLEINANZEIGEN_AD]['value']['id']
+    details_body = encode(details)
+    def details_setup():
+        fresh_cache()
+        _, listing = parser.parse_ad(search[KLEINANZEIGEN_ADS]['value']['ad'][0])
+        listing.id = id
+        parser.cached_ads[id] = listing
+        return [parser.details_decoder.loads(details_body) for _ in range(batch)]
+    async def parse_details(payloads):
+        for payload in payloads:
+            await parser.parse_ad_details(payload)
+        return len(payloads)
+    results.append(bench('kleinanzeigen.parse_ad_details', batch, details_setup, lambda x: loop.run_until_complete(parse_details(x)), repeat))
+    return results
+
+
+def check_typed_decoding():
+    """Every fixture has to decode on the typed path, a schema fallback would decode each response twice"""
+    from cogs.parsers import schemas
+    from cogs.parsers.decoding import Decoder
+
+    cases = {
+        'kleinanzeigen_search.json' : schemas.KleinanzeigenSearch,
+        'kleinanzeigen_details.json' : schemas.KleinanzeigenDetails,
+        'ebay_search.json' : schemas.EbaySearch,
+        'ebay_details.json' : schemas.EbayDetails,
+    }
+    for name, schema in cases.items():
+        decoder = Decoder(schema, Config.FAST_JSON)
+        if not decoder.typed:
+            return # msgspec not installed or fast decoding disabled
+        decoder.loads(encode(load_fixture(name)))
+        assert not decoder.fallbacks, f'{name} does not match its schema, decoding falls back to the full tree'
+
+
+def check_restart_resume(loop):
+    """A listing published after the last recorded poll started but never seen is still new after a restart"""
+    from datetime import datetime, timezone
+    from cogs.parsers.ebay_parser import EbayParser
+
+    search = load_fixture('kleinanzeigen_search.json')
+    ad = search[KLEINANZEIGEN_ADS]['value']['ad'][0]
+    ad['start-date-time']['value'] = datetime.fromtimestamp(time() - 30, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000%z')
+    search[KLEINANZEIGEN_ADS]['value']['ad'] = [ad]
+
+    cache_path = Config.CACHE_PATH
+    try:
+        with TemporaryDirectory() as restart_path:
+            Config.CACHE_PATH = restart_path
+            before = EbayParser(FixtureSession({}))
+            loop.run_until_complete(before.save_ads_to_file(polled_at=time() - 60))
+            before.close() # Shut down after the listing got published
+
+            after = EbayParser(FixtureSession({}))
+            after.enrich = lambda id: None
+            new_ads = loop.run_until_complete(after.parse_search_result(search))
+            after.close()
+    finally:
+        Config.CACHE_PATH = cache_path
+    assert new_ads == [ad['id']], 'Listing published before shutdown was not announced after a restart'
+
+
+def run_ebay(loop, sizes, repeat):
+    from cogs.parsers.big_ebay_parser import BigEbayParser
+    from cogs.parsers.listing_cache import ListingCache
+
+    search = load_fixture('ebay_search.json')
+    parser = BigEbayParser(None)
+
+    results = []
+    for size in sizes:
+        payload = scale_ebay_search(search, size)
+        size = sum(1 for k in payload['modules'] if k.startswith('listing'))
+        body = encode(payload)
+
+        def decode_search(body):
+            parser.search_decoder.loads(body)
+            return size
+        results.append(bench('ebay.decode_search', size, lambda: body, decode_search, repeat))
+
+        def parse_search(payload):
+            return len(parser.parse_results(payload))
+        def search_setup():
+            parser.cached_ads = ListingCache(Config.LISTING_CACHE_SIZE, Config.LISTING_CACHE_MAX_AGE)
+            return parser.search_decoder.loads(body)
+        results.append(bench('ebay.parse_results', size, search_setup, parse_search, repeat))
+
+        # Category guess decodes the whole search response with the generic decoder
+        parser.session = FixtureSession({'search_results' : body})
+        def get_category(_):
+            category, _name = loop.run_until_complete(parser.get_category({}))
+            assert category, 'Category not found in fixture'
+            return size
+        results.append(bench('ebay.get_category', size, lambda: None, get_category, repeat))
+    return results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Offline parser benchmarks')
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=[0, 1000, 5000], help='Listings per synthetic search result, 0 runs the stored fixture as is')
+    arg_parser.add_argument('--repeat', type=int, default=20, help='Timed calls per case')
+    arg_parser.add_argument('--output', default='bench_results.json', help='Where to write the JSON report')
+    args = arg_parser.parse_args()
+
+    check_typed_decoding()
+    loop = asyncio.new_event_loop()
+    with TemporaryDirectory() as cache_path:
+        Config.CACHE_PATH = cache_path
+        check_restart_resume(loop)
+        results = run_kleinanzeigen(loop, args.sizes, args.repeat) + run_ebay(loop, args.sizes, args.repeat)
+    loop.close()
+
+    report = {
+        'created' : int(time()),
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'fast_json' : Config.FAST_JSON,
+        'results' : results,
+    }
+    with open(args.output, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2)
+    for x in results:
+        print(f"{x['name']:<36} {x['size']:>6} {x['listings_per_sec'] or 0:>12.0f}/s  p50 {x['p50_ms']:>9.3f}ms  p95 {x['p95_ms']:>9.3f}ms  p99 {x['p99_ms']:>9.3f}ms  blocks {x['alloc_blocks']:>7}  peak {x['peak_kib']:>9.1f}KiB")
+    print(f'Wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,13 +8,21 @@ from logging import getLogger
 
 from discord.utils import MISSING
 from cogs.parsers.big_ebay_parser import BigEbayParser
+from cogs.utils.polling import BoundedPoller
+from cogs.utils.scheduler import QueryScheduler
+from cogs.utils.coalescing import SearchCoalescer
+from cogs.utils.planner import SearchPlanner
+from cogs.utils.freshness import FreshnessTracker
+from cogs.utils.sniping import sleep_until
+from cogs.utils.targets import TargetScheduler
+from cogs.parsers.rate_limit import TokenBucket
 from traceback import format_exc
 from os import path
-from random import randint
-from asyncio import sleep as aio_sleep, create_task, CancelledError, TimeoutError
+from asyncio import sleep as aio_sleep, create_task, gather, CancelledError, TimeoutError, Queue, QueueFull
 from datetime import datetime
 from config import Config
-from time import time
+from time import monotonic, time
+from metrics import BID_SEND_OFFSET, CYCLE_DURATION, DISCORD_SEND_LATENCY, LISTINGS_ANNOUNCED
 
 # class ListExistingView(ui.View):
 #     def __init__(self, options):
@@ -135,16 +143,27 @@ class BigEbayCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.logger = getLogger('market_bot.ebay')
-        self.queries = {} # thread id : {name, params, jump_url}
-        self.targets = {}
-        self.targetTasks = {}
+        self.queries = {} # thread id : {name, params, jump_url, firstTime, mention, interval, jitter}
+        # Armed bids, the final approach starts when the bid connection gets warmed up
+        self.targets = TargetScheduler(self.snipe, self.logger, f'{Config.CACHE_PATH}/big_ebay_targets.pkl', lead=Config.BID_PREWARM_SECONDS)
         self.filepath = f'{Config.CACHE_PATH}/big_ebay_queries.json'
         self.guild = None
         self.manage_msg = None
         self.parser = None
+        self.poller = BoundedPoller(Config.MAX_CONCURRENT_SEARCHES['BigEbayCommands'], self.logger)
+        self.scheduler = QueryScheduler(self.update_search, self.logger)
+        self.searches = SearchCoalescer() # threads grouped by identical search params
+        self.planner = SearchPlanner('_udlo', '_udhi') # searches merged by everything but price
+        self.freshness = FreshnessTracker('ebay', Config.FRESHNESS_WINDOW)
+        # Search results have no start date, it is looked up after announcing
+        self.start_date_queue = Queue(maxsize=1000)
+        self.start_date_pending = {} # listing id : [(query, sent_at)]
+        self.start_date_bucket = TokenBucket(Config.EBAY_START_DATE_RATE, 1) if Config.EBAY_START_DATE_RATE else None
+        self.start_date_worker = None
         self.prepare_options()
         self.load_queries_from_file()
         self.worker = create_task(self.keep_updated())
+        self.targets.start()
         self.ctx_menu_target = app_commands.ContextMenu(
             name='Target',
             callback=self.target_menu,
@@ -154,8 +173,16 @@ class BigEbayCommands(commands.Cog):
     def _set_essentials(self, session):
         self.parser: BigEbayParser = BigEbayParser(session)
 
+    def set_bid_session(self, session):
+        self.parser.set_bid_session(session)
+
     def cog_unload(self):
         self.worker.cancel()
+        self.targets.stop()
+        if self.start_date_worker:
+            self.start_date_worker.cancel()
+        if self.parser:
+            self.parser.close()
         self.bot.tree.remove_command(self.ctx_menu_target.name, type=self.ctx_menu_target.type)
 
     def prepare_options(self):
@@ -250,17 +277,36 @@ class BigEbayCommands(commands.Cog):
                         'params' : params,
                         'jump_url' : new_thread.jump_url,
                         'firstTime' : True,
-                        'mention' : interaction.user.mention
+                        'mention' : interaction.user.mention,
+                        'interval' : Config.EBAY_UPDATE_INTERVAL,
+                        'jitter' : 0.5
                     }
+                    self.schedule_query(new_thread.id)
                     self.save_queries_to_file()
             except Exception as e:
-                self.logger.error(f'{format_exc()}')
+                self.logger.exception('Failed to create search thread')
         else:
             await interaction.response.send_message('Queries cannot be submitted from here', ephemeral=True)
 
+    @app_commands.command(
+            name='ebay_interval',
+            description='Change how often current thread is updated')
+    @app_commands.describe(seconds='Seconds between updates', jitter='Random spread of the interval, from 0 to 0.9')
+    async def ebay_interval(self, interaction: discord.Interaction, seconds: app_commands.Range[int, 20, 24*60*60], jitter: app_commands.Range[float, 0.0, 0.9] = 0.5):
+        query = self.queries.get(interaction.channel_id, None)
+        if query:
+            query['interval'] = seconds
+            query['jitter'] = jitter
+            self.schedule_query(interaction.channel_id, delay=seconds)
+            self.save_queries_to_file()
+            await interaction.response.send_message(f'Thread will be updated every `{seconds}`s (±{int(jitter*100)}%)', ephemeral=True)
+        else:
+            await interaction.response.send_message('This thread is not managed by market bot', ephemeral=True)
+
     async def delete_thread(self, thread: discord.Thread):
         if thread.id in self.queries.keys():
             del self.queries[thread.id]
+            self.unschedule_query(thread.id)
             self.save_queries_to_file()
         else:
             self.logger.warning(f'Was asked to delete thread `{thread.name}` but it was not found in cache')
@@ -270,47 +316,64 @@ class BigEbayCommands(commands.Cog):
         await interaction.response.send_message('Not implemented', ephemeral=True)
 
     async def wait_until(self, until_ts):
-        # sleep until the specified datetime
-        await aio_sleep(until_ts-time())
-
-    async def run_at(self, ts, coro, listing_id):
+        # sleep until the specified timestamp, returns the monotonic deadline
+        return await sleep_until(until_ts, Config.SNIPE_SPIN, Config.SNIPE_LOCK_IN)
+
+    async def snipe(self, listing_id, target):
+        # Started by the target scheduler BID_PREWARM_SECONDS ahead, only sending is left at the deadline
+        ts = target['targetTime']
+        bid = self.parser.prepare_bid(listing_id, target['price'], target['sid'])
+        warmer = create_task(self.keep_bid_session_warm(listing_id, ts))
         try:
-            await self.wait_until(ts)
-            return await coro
+            # `ts` is on eBay's clock, the offset is refreshed shortly before and applied
+            await sleep_until(ts - Config.CLOCK_SYNC_BEFORE, spin=0)
+            await self.parser.sync_clock()
+            self.logger.info(f'Bid on {listing_id} at {ts}, server clock {self.parser.clock.describe()}')
+            planned = await self.wait_until(ts - self.parser.clock.offset)
         except CancelledError:
-            self.logger.info('Cancelled task')
-            if listing_id in self.targets.keys():
-                self.targets.pop(listing_id)
-            await coro
-            self.targetTasks.pop(listing_id)
-
-    async def targetListing(self, listing_id, price, sid=None):
-        if listing_id in self.targets.keys():
-            highest, text = await self.parser.place_bid(listing_id, price, sid)
-            channel : discord.Thread = await self.bot.fetch_channel(self.targets[listing_id]['threadId'])
-            if channel:
-                await channel.send(text)
-            infoMsg = await channel.fetch_message(self.targets[listing_id]['infoMsgId'])
-            if infoMsg:
-                await infoMsg.delete()
+            self.logger.info(f'Cancelled bid on {listing_id}')
+            raise
+        finally:
+            warmer.cancel()
+        await self.targetListing(listing_id, bid, planned)
+
+    async def keep_bid_session_warm(self, listing_id, ts, margin=1.5):
+        # The last warm-up goes out `margin` seconds before the bid, so it is done when the bid needs the connection
+        while (remaining := ts - time() - margin) > 0:
+            connect = await self.parser.warm_bid_session()
+            if connect:
+                self.logger.info(f'Opened bid connection for {listing_id} in {connect*1000:.0f}ms')
+            await aio_sleep(min(Config.BID_KEEPALIVE_INTERVAL, remaining))
+
+    async def delete_info_message(self, channel, target):
+        try:
+            infoMsg = await channel.fetch_message(target['infoMsgId'])
+            await infoMsg.delete()
+        except discord.HTTPException:
+            pass
+
+    async def targetListing(self, listing_id, bid, planned):
+        target = self.targets.get(listing_id)
+        if not target:
+            return
+        highest, text = await self.parser.send_bid(bid)
+        offset = bid['sent_at'] - planned
+        BID_SEND_OFFSET.observe(abs(offset))
+        connection = f'new connection opened in {bid["connect"]*1000:.0f}ms' if bid['connect'] else 'warm connection'
+        self.logger.info(f'Bid on {listing_id} sent {offset*1000:+.1f}ms from plan over {connection}, answered {(monotonic() - bid["sent_at"])*1000:.0f}ms later')
+        channel : discord.Thread = await self.bot.fetch_channel(target['threadId'])
+        if channel:
+            await channel.send(text)
+            await self.delete_info_message(channel, target)
             if highest:
-                listings_id_to_delete = []
-                targetThreadId = self.targets[listing_id]['threadId']
-                for k, v in self.targets:
-                    if k != listing_id:
-                        if v['threadId'] == targetThreadId:
-                            infoMsg = await channel.fetch_message(self.targets[listing_id]['infoMsgId'])
-                            if infoMsg:
-                                await infoMsg.delete()
-                            listings_id_to_delete.append(k)
-                for listingid in listings_id_to_delete:
-                    self.targets.pop(listing_id)
-                    if listingid in self.targetTasks.keys():
-                        self.targetTasks[listingid].cancel()
-                await channel.send('All other targets were unscheduled')
-
-            self.targets.pop(listing_id)
-            self.targetTasks.pop(listing_id)
+                # Won in this thread, the other targets of it are dropped
+                others = [(k, v) for k, v in self.targets.items() if k != listing_id and v['threadId'] == target['threadId']]
+                for other_id, other in others:
+                    self.targets.disarm(other_id)
+                    await self.delete_info_message(channel, other)
+                if others:
+                    await channel.send('All other targets were unscheduled')
+        self.targets.disarm(listing_id)
 
 
     @commands.Cog.listener()
@@ -322,17 +385,12 @@ class BigEbayCommands(commands.Cog):
             if user.id != self.bot.user.id:
                 try:
                     listing_id = int(message.content.split('ebay.de/itm/')[1].split(')')[0])
-                    if listing_id in self.targets.keys():
-                        targetTask = self.targetTasks[listing_id]
-                        infoMsg = await channel.fetch_message(self.targets[listing_id]['infoMsgId'])
-                        if infoMsg:
-                            await infoMsg.delete()
-                        targetTitle = self.targets[listing_id]['targetTitle']
-                        self.targets.pop(listing_id, None)
-                        targetTask.cancel()
-                        await channel.send(f'{user.mention}, listing **{targetTitle}** was removed from schedule', delete_after=60)
+                    target = self.targets.disarm(listing_id)
+                    if target:
+                        await self.delete_info_message(channel, target)
+                        await channel.send(f'{user.mention}, listing **{target["targetTitle"]}** was removed from schedule', delete_after=60)
                 except Exception as e:
-                    self.logger.info(f'{format_exc()}')
+                    self.logger.info('Failed to handle reaction', exc_info=True)
 
     async def target_menu(self, interaction: discord.Interaction, message: discord.Message):
         if len(message.embeds) > 0 and message.channel.id in self.queries.keys():
@@ -340,31 +398,31 @@ class BigEbayCommands(commands.Cog):
                 listingEmbed = message.embeds[0]
                 listingId = int(listingEmbed.url.split('/')[-1])
                 listingName = listingEmbed.title
-                if listingId in self.targets.keys():
+                if listingId in self.targets:
                     await interaction.response.send_message(f'Selected listing is already targeted', ephemeral=True)
                 else:
                     listing = await self.parser.getAuction(listingId)
                     if listing:
-                        if listing.get('isAuction'):
+                        if listing.isAuction:
                             targetModal = TargetModal()
                             await interaction.response.send_modal(targetModal)
                             await targetModal.wait()
                             try:
                                 price = float(targetModal.maxPrice)
                                 bidOffset = int(targetModal.bidTime)
-                                targetTime = listing['endDate']-bidOffset
-                                msgText = f"Auction started at <t:{listing['startDate']}>\nAuction ends at <t:{listing['endDate']}>\nWill bid **{price:.2f}**€ <t:{targetTime}:R>"
+                                targetTime = listing.endDate-bidOffset
+                                msgText = f"Auction started at <t:{listing.startDate}>\nAuction ends at <t:{listing.endDate}>\nWill bid **{price:.2f}**€ <t:{targetTime}:R>\nServer clock {self.parser.clock.describe()}"
                                 listingUrl = f'https://www.ebay.de/itm/{listingId}'
                                 await targetModal.formInteraction.response.send_message(f'{interaction.user.mention},\n[{listingName}]({listingUrl})\n\n{msgText}', suppress_embeds=True)
                                 infoMsg = await targetModal.formInteraction.original_response()
-                                self.targets[listingId] = {
+                                self.targets.arm(listingId, {
                                     'targetTime' : targetTime,
-                                    'sid' : listing['sid'],
+                                    'price' : price,
+                                    'sid' : listing.sid,
                                     'infoMsgId' : infoMsg.id,
                                     'threadId' : message.channel.id,
-                                    'targetTitle' : listing['title'],
-                                }
-                                self.targetTasks[listingId] = create_task(self.run_at(targetTime, self.targetListing(listingId, price, listing['sid']), listingId))
+                                    'targetTitle' : listing.title,
+                                })
                                 await infoMsg.add_reaction('🎯')
                             except Exception as e:
                                 await interaction.channel.send(f'{interaction.user.mention}, error during bid scheduling: {format_exc()}', delete_after=60)
@@ -373,7 +431,7 @@ class BigEbayCommands(commands.Cog):
                     else:
                         await interaction.response.send_message(f'Listing with id **{listingId}** doesn\'t exist', ephemeral=True)
             except Exception as e:
-                self.logger.error(f'{format_exc()}')
+                self.logger.exception('Failed to schedule bid')
         else:
             await interaction.response.send_message("App can't be called from here", ephemeral=True)
 
@@ -383,26 +441,26 @@ class BigEbayCommands(commands.Cog):
     )
     @app_commands.describe(listing_id="ID of listing to target", price="Price to target", target_at="Target at")
     async def target(self, interaction: discord.Interaction, listing_id: int, price:float, target_at:int=2):
-        if listing_id in self.targets.keys():
+        if listing_id in self.targets:
             await interaction.response.send_message('Selected listing is already targeted', ephemeral=True)
             return
         try:
             listing = await self.parser.getAuction(listing_id)
             if listing:
-                if listing.get('isAuction'):
-                    targetTime = listing['endDate']-target_at
-                    msgText = f"Auction started at <t:{listing['startDate']}>\nAuction ends at <t:{listing['endDate']}>\nWill bid **{price:.2f}**€ <t:{targetTime}:R>"
+                if listing.isAuction:
+                    targetTime = listing.endDate-target_at
+                    msgText = f"Auction started at <t:{listing.startDate}>\nAuction ends at <t:{listing.endDate}>\nWill bid **{price:.2f}**€ <t:{targetTime}:R>\nServer clock {self.parser.clock.describe()}"
                     listingUrl = f'https://www.ebay.de/itm/{listing_id}'
-                    await interaction.response.send_message(f'{interaction.user.mention},\n[{listing["title"]}]({listingUrl})\n\n{msgText}', suppress_embeds=True)
+                    await interaction.response.send_message(f'{interaction.user.mention},\n[{listing.title}]({listingUrl})\n\n{msgText}', suppress_embeds=True)
                     infoMsg = await interaction.original_response()
-                    self.targets[listing_id] = {
+                    self.targets.arm(listing_id, {
                         'targetTime' : targetTime,
-                        'sid' : listing['sid'],
+                        'price' : price,
+                        'sid' : listing.sid,
                         'infoMsgId' : infoMsg.id,
                         'threadId' : interaction.channel_id,
-                        'targetTitle' : listing['title'],
-                    }
-                    self.targetTasks[listing_id] = create_task(self.run_at(targetTime, self.targetListing(listing_id, price, listing['sid']), listing_id))
+                        'targetTitle' : listing.title,
+                    })
                     await infoMsg.add_reaction('🎯')
                 else:
                     await interaction.response.send_message(f'Listing isn\'t an auction', ephemeral=True)    
@@ -418,18 +476,12 @@ class BigEbayCommands(commands.Cog):
     @app_commands.describe(listing_id="ID of listing to untarget")
     async def untarget(self, interaction: discord.Interaction, listing_id: int):
         try:
-            if listing_id in self.targets.keys():
-                targetTask = self.targetTasks[listing_id]
-                infoMsg = await interaction.channel.fetch_message(self.targets[listing_id]['infoMsgId'])
-                if infoMsg:
-                    await infoMsg.delete()
-                targetTitle = self.targets[listing_id]['targetTitle']
-                self.targets.pop(listing_id, None)
-                targetTask.cancel()
-                #self.targetTasks.pop(listingId, None)
-                await interaction.response.send_message(f'Listing **{targetTitle}** was removed from schedule', delete_after=60)
+            target = self.targets.disarm(listing_id)
+            if target:
+                await self.delete_info_message(interaction.channel, target)
+                await interaction.response.send_message(f'Listing **{target["targetTitle"]}** was removed from schedule', delete_after=60)
         except Exception as e:
-            self.logger.error(f'{format_exc()}')
+            self.logger.exception('Failed to untarget listing')
 
     def save_queries_to_file(self):
         with open(self.filepath, 'wb') as f:
@@ -439,9 +491,7 @@ class BigEbayCommands(commands.Cog):
         if path.isfile(self.filepath):
             with open(self.filepath, 'rb') as f:
                 self.queries = pickle.load(f)
-                print(f'Loaded queries: {self.queries}')
-            for _, v in self.queries.items():
-                v['firstTime'] = True
+                self.logger.info(f'Loaded {len(self.queries)} queries')
 
     def get_auction_left_time(self, endDate):
         diff = datetime.now() - endDate
@@ -453,54 +503,148 @@ class BigEbayCommands(commands.Cog):
 
     def get_ebay_embed(self, ad_id):
         ad = self.parser.cached_ads[ad_id]
-        price_text = f"{ad['price']}€ {ad['shipping']}"
-        embed = Embed(title=ad['title'], url=ad['url']) \
-        .set_author(name=f"{ad['sellerName']}, {ad['sellerType']}", url=ad['userUrl']) \
-        .add_field(name=f'{("Current price" if ad["isAuction"] else "Price")}', value=price_text) \
-        .add_field(name='Condition', value=ad['condition'])
-        if ad['isAuction']:
-            # embed.timestamp = datetime.fromtimestamp(ad['startDate'])
-            if ad.get('endDate'):
-                embed.add_field(name='Ends in', value=self.get_auction_left_time(datetime.fromtimestamp(ad['endDate'])))
-            buyNowText = f'Buy Now\n' if ad['buyNow'] else ''
-            priceSuggestionText = f'Preisvorschlag' if ad['priceSuggestion'] else ''
+        price_text = f"{ad.price_text}€ {ad.shipping}"
+        embed = Embed(title=ad.title, url=ad.url) \
+        .set_author(name=f"{ad.sellerName}, {ad.sellerType}", url=ad.userUrl) \
+        .add_field(name=f'{("Current price" if ad.isAuction else "Price")}', value=price_text) \
+        .add_field(name='Condition', value=ad.condition)
+        if ad.isAuction:
+            # embed.timestamp = datetime.fromtimestamp(ad.startDate)
+            if ad.endDate:
+                embed.add_field(name='Ends in', value=self.get_auction_left_time(datetime.fromtimestamp(ad.endDate)))
+            buyNowText = f'Buy Now\n' if ad.buyNow else ''
+            priceSuggestionText = f'Preisvorschlag' if ad.priceSuggestion else ''
             embed.add_field(name='Auction', value=f'{buyNowText}{priceSuggestionText}')
-        if ad.get('img'):
-            embed.set_image(url=ad['img'])
-        return ad['title'], price_text, embed, ad['isAuction']
+        if ad.img:
+            embed.set_image(url=ad.img)
+        return ad.title, price_text, embed, ad.isAuction
+
+    def planned_keys(self, base):
+        return [key for key in self.searches if self.planner.base_key(self.searches.params(key)) == base]
+
+    def schedule_query(self, thread_id, delay=0):
+        params = self.queries[thread_id]['params']
+        self.searches.subscribe(thread_id, params)
+        self.schedule_search(self.planner.base_key(params), delay)
+
+    def unschedule_query(self, thread_id):
+        bases = {self.planner.base_key(self.searches.params(key)) for key in self.searches if thread_id in self.searches.subscribers(key)}
+        self.searches.unsubscribe(thread_id)
+        for base in bases:
+            if self.planned_keys(base):
+                self.schedule_search(base, delay=Config.EBAY_UPDATE_INTERVAL)
+            else:
+                self.scheduler.unschedule(base)
+
+    def schedule_search(self, base, delay=0):
+        # Merged search runs as often as its most demanding subscriber wants
+        subscribed = [self.queries[x] for key in self.planned_keys(base) for x in self.searches.subscribers(key) if x in self.queries]
+        if not subscribed:
+            # Every thread of it was deleted already
+            self.scheduler.unschedule(base)
+            return
+        interval = min(x.get('interval', Config.EBAY_UPDATE_INTERVAL) for x in subscribed)
+        jitter = min(x.get('jitter', 0.5) for x in subscribed)
+        due = self.scheduler.next_due(base)
+        self.scheduler.schedule(base, interval, jitter, delay if due is None else min(due, delay))
 
-    async def keep_updated(self):
-        await self.bot.wait_until_ready()
+    def listing_filter_fields(self, ad_id):
+        ad = self.parser.cached_ads[ad_id]
+        return ad.price, ad.title
+
+    async def announce(self, thread, mention, new_ads, query=''):
+        try:
+            for ad_id in new_ads:
+                title, price, embed, isAuction = self.get_ebay_embed(ad_id)
+                with DISCORD_SEND_LATENCY.time(marketplace='ebay'):
+                    listingMsg = await thread.send(content=f'{mention} {title} **{price}**', embed=embed)
+                LISTINGS_ANNOUNCED.inc(marketplace='ebay', query=query)
+                self.track_freshness(ad_id, query, time())
+                await aio_sleep(0.5)
+        except Exception as e:
+            self.logger.exception('Error during update')
+
+    def track_freshness(self, ad_id, query, sent_at):
+        ad = self.parser.cached_ads.get(ad_id)
+        if not ad:
+            return
+        self.freshness.sent(query, ad.startDate, ad.detected_at, sent_at)
+        if ad.startDate or not self.start_date_bucket:
+            return
+        if ad_id in self.start_date_pending:
+            self.start_date_pending[ad_id].append((query, sent_at))
+            return
+        try:
+            self.start_date_queue.put_nowait(ad_id)
+            self.start_date_pending[ad_id] = [(query, sent_at)]
+        except QueueFull:
+            pass
+
+    async def start_date_updater(self):
         while True:
-            if self.guild and self.parser:
-                to_delete = []
-                for thread_id, v in self.queries.items():
-                    try:
-                        thread = self.guild.get_channel_or_thread(thread_id)
-                        if thread:
-                            await self.parser.search_offers(v['params'], v['firstTime'])
-                            if v['firstTime']:
-                                v['firstTime'] = False
-                            for ad_id in self.parser.non_announced:
-                                title, price, embed, isAuction = self.get_ebay_embed(ad_id)
-                                listingMsg = await thread.send(content=f'{v["mention"]} {title} **{price}**', embed=embed)
-                                await aio_sleep(0.5)
-                            self.parser.non_announced = []   
-                        else:
-                            to_delete.append(thread_id)
-                            continue
-                        await aio_sleep(2)
-                    except Exception as e:
-                        self.logger.error(f'Error during update: {format_exc()}')
-                #await self.parser.save_ads_to_file()
-                for id in to_delete:
-                    del self.queries[id]
-                self.save_queries_to_file()
-            await aio_sleep(randint(Config.EBAY_UPDATE_INTERVAL*0.5, Config.EBAY_UPDATE_INTERVAL*1.5))
-            #self.keep_updated.change_interval(seconds=randint(Config.EBAY_UPDATE_INTERVAL*0.5, Config.EBAY_UPDATE_INTERVAL*1.5))
+            ad_id = await self.start_date_queue.get()
+            try:
+                await self.start_date_bucket.acquire()
+                await self.parser.get_details(ad_id)
+                ad = self.parser.cached_ads.get(ad_id)
+                if ad and ad.startDate:
+                    for query, sent_at in self.start_date_pending.get(ad_id, ()):
+                        self.freshness.published(query, ad.startDate, ad.detected_at, sent_at)
+            except CancelledError:
+                raise
+            except Exception:
+                self.logger.exception(f'Failed to get start date of {ad_id}')
+            finally:
+                self.start_date_pending.pop(ad_id, None)
+
+    async def update_search(self, base):
+        if not self.guild or not self.parser:
+            return
+        threads = {}
+        for key in self.planned_keys(base):
+            for thread_id in self.searches.subscribers(key):
+                thread = self.guild.get_channel_or_thread(thread_id)
+                if thread and thread_id in self.queries:
+                    threads[thread_id] = thread
+                else:
+                    self.queries.pop(thread_id, None)
+                    self.unschedule_query(thread_id)
+                    self.save_queries_to_file()
+        keys = self.planned_keys(base)
+        if not threads or not keys:
+            return
+        started = monotonic()
+        plans = self.planner.plan(self.searches, keys)
+        results = await gather(*(self.poller.limited(self.parser.search_offers(plan['params'], plan['match']), default=[]) for plan in plans))
+        await self.parser.save_ads_to_file()
+        if len(keys) > len(plans):
+            self.logger.debug(f'Merged {len(keys)} searches into {len(plans)}, saved {len(keys) - len(plans)} requests')
+        jobs = []
+        for plan, new_ads in zip(plans, results):
+            for key, window in plan['entries']:
+                matching = self.planner.matching(window, self.listing_filter_fields, new_ads)
+                for thread_id in self.searches.subscribers(key):
+                    query = self.queries.get(thread_id, None)
+                    if not query or thread_id not in threads:
+                        continue
+                    if query['firstTime']:
+                        # First run only fills the cache
+                        query['firstTime'] = False
+                        self.save_queries_to_file()
+                    elif matching:
+                        jobs.append(self.announce(threads[thread_id], query['mention'], matching, plan['params'].get('_nkw', '')))
+        await gather(*jobs)
+        CYCLE_DURATION.observe(monotonic() - started, marketplace='ebay')
+        self.freshness.maybe_report(self.logger, Config.FRESHNESS_SLOW_QUERY)
 
-    def cog_unload(self):
-        self.worker.cancel()
+    async def keep_updated(self):
+        await self.bot.wait_until_ready()
+        # Spread the first runs out instead of firing every query at once
+        for idx, thread_id in enumerate(list(self.queries.keys())):
+            self.schedule_query(thread_id, delay=idx*2)
+        if self.start_date_bucket:
+            self.start_date_worker = create_task(self.start_date_updater())
+        await self.scheduler.run()
 
 
 async def setup(bot):
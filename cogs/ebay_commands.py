@@ -5,18 +5,22 @@ from discord import app_commands, Embed, Interaction, ButtonStyle, ChannelType,
 from typing import Optional
 from logging import getLogger
 from cogs.parsers.ebay_parser import EbayParser
-from traceback import format_exc
+from cogs.utils.polling import BoundedPoller
+from cogs.utils.coalescing import SearchCoalescer
+from cogs.utils.planner import SearchPlanner
+from cogs.utils.freshness import FreshnessTracker
 from os import path
 from random import randint
-from asyncio import create_task, sleep as aio_sleep
-from datetime import datetime
+from asyncio import create_task, gather, sleep as aio_sleep
+from datetime import datetime, timezone
+from time import monotonic, time
 from config import Config
+from metrics import CYCLE_DURATION, DISCORD_SEND_LATENCY, LISTINGS_ANNOUNCED
 
 class SmolEbayDropdown(discord_ui.Select):
     def __init__(self, cog, view, options):
         self._cog = cog
         self._view = view
-        print(self._cog.queries)
         super().__init__(placeholder='Select queries you want to remove..', min_values=1, max_values=len(options), options=options, row=0)
 
     async def callback(self, interaction: Interaction):
@@ -50,6 +54,9 @@ class SmolEbayCommands(commands.Cog):
         self.filepath = f'{Config.CACHE_PATH}/ebay_queries.json'
         self.guild = None
         self.manage_msg = None
+        self.poller = BoundedPoller(Config.MAX_CONCURRENT_SEARCHES['SmolEbayCommands'], self.logger)
+        self.planner = SearchPlanner('minPrice', 'maxPrice', 'exclude')
+        self.freshness = FreshnessTracker('kleinanzeigen', Config.FRESHNESS_WINDOW)
         self.load_queries_from_file()
 
     def _set_essentials(self, session):
@@ -83,7 +90,7 @@ class SmolEbayCommands(commands.Cog):
                 await interaction.response.send_message(f'Subscribed to {new_thread.jump_url}')
                 self.save_queries_to_file()
             except Exception as e:
-                self.logger.error(f'Failed to create thread with {search_args} due to: {format_exc()}')
+                self.logger.exception(f'Failed to create thread with {search_args}')
                 await interaction.response.send_message('Failed to create thread, check logs', ephemeral=True)
         elif channel.type == ChannelType.public_thread and channel.id in self.queries.keys():
             self.queries[channel.id]['kwargs'].append(search_args)
@@ -119,53 +126,86 @@ class SmolEbayCommands(commands.Cog):
         if path.isfile(self.filepath):
             with open(self.filepath, 'rb') as f:
                 self.queries = pickle.load(f)
-                print(f'Loaded queries: {self.queries}')
+                self.logger.info(f'Loaded {len(self.queries)} queries')
+
+    def listing_filter_fields(self, ad_id):
+        ad = self.parser.cached_ads[ad_id]
+        return ad.price, ad.title
 
     def get_ebay_embed(self, ad_id):
         ad = self.parser.cached_ads[ad_id]
-        if type(ad['publish_date']) != datetime:
-            ad['publish_date'] = datetime.fromisoformat(ad['publish_date'])
-        price_text = ' '.join([f'{ad["price"]}€', ad['vb'], ('✅' if ad['safe_payment'] else '')])
-        embed = Embed(title=ad['title'], description=ad['description'], timestamp=ad['publish_date'], url=ad['link']) \
-        .set_footer(text=ad['address']).set_author(name=ad['sellerName']) \
+        price_text = ' '.join([f'{ad.price_text}€', ad.vb, ('✅' if ad.safe_payment else '')])
+        embed = Embed(title=ad.title, description=ad.description, timestamp=datetime.fromtimestamp(ad.publish_date, timezone.utc), url=ad.url) \
+        .set_footer(text=ad.address).set_author(name=ad.sellerName) \
         .add_field(name='Price', value=price_text) \
-        .add_field(name='Shipping', value=('Moglich' if ad['versand'] else 'Nur Abholdung'))
-        if ad['averageRating']:
-            embed.add_field(name='User Score', value=round(ad['averageRating'], 2))
-        if ad.get('img', None):
-            embed.set_image(url=ad['img'])
-        return ad['title'], price_text, embed
+        .add_field(name='Shipping', value=('Moglich' if ad.versand else 'Nur Abholdung'))
+        if ad.averageRating:
+            embed.add_field(name='User Score', value=round(ad.averageRating, 2))
+        if ad.img:
+            embed.set_image(url=ad.img)
+        return ad.title, price_text, embed
             
+    async def announce(self, thread, new_ads):
+        """`new_ads` maps listing ids to the query that found them"""
+        try:
+            # Details are fetched concurrently, each listing goes out as soon as its own and earlier ones are ready
+            for ad_id, query in new_ads.items():
+                if not await self.parser.enriched(ad_id):
+                    continue
+                title, price, embed = self.get_ebay_embed(ad_id)
+                with DISCORD_SEND_LATENCY.time(marketplace='kleinanzeigen'):
+                    await thread.send(content=f'<@&{Config.SMOL_EBAY_MENTION_ROLE}> {title} **{price}**', embed=embed)
+                LISTINGS_ANNOUNCED.inc(marketplace='kleinanzeigen', query=query)
+                ad = self.parser.cached_ads.get(ad_id)
+                if ad:
+                    self.freshness.sent(query, ad.publish_date, ad.detected_at)
+                await aio_sleep(0.5)
+        except Exception as e:
+            self.logger.exception('Error during update')
+
     async def keep_updated(self):
         await self.bot.wait_until_ready()
         while True:
             if self.guild:
+                polled_at = time()
+                started = monotonic()
                 to_delete = []
+                threads = {}
+                searches = SearchCoalescer()
                 for thread_id, v in self.queries.items():
-                    try:
-                        thread = self.guild.get_channel_or_thread(thread_id)
-                        if thread:
-                            for kwargs in v['kwargs']:
-                                await self.parser.search(**kwargs)
-                                for ad_id in self.parser.non_announced:
-                                    title, price, embed = self.get_ebay_embed(ad_id)
-                                    await thread.send(content=f'<@&{Config.SMOL_EBAY_MENTION_ROLE}> {title} **{price}**', embed=embed)
-                                    await aio_sleep(0.5)
-                                self.parser.non_announced = []   
-                        else:
-                            to_delete.append(thread_id)
-                            continue
-                        await aio_sleep(2)
-                    except Exception as e:
-                        self.logger.error(f'Error during update: {format_exc()}')
-                await self.parser.save_ads_to_file()
+                    thread = self.guild.get_channel_or_thread(thread_id)
+                    if thread:
+                        threads[thread_id] = thread
+                        for kwargs in v['kwargs']:
+                            searches.subscribe(thread_id, kwargs)
+                    else:
+                        to_delete.append(thread_id)
+                # Every distinct query text runs once per group of overlapping price windows,
+                # new listings go to every subscribed thread whose window and exclude they match
+                plans = self.planner.plan(searches)
+                results = await gather(*[self.poller.limited(self.parser.search(**plan['params'], match=plan['match']), default=[]) for plan in plans])
+                announcements = {}
+                for plan, new_ads in zip(plans, results):
+                    for key, window in plan['entries']:
+                        matching = self.planner.matching(window, self.listing_filter_fields, new_ads)
+                        for thread_id in searches.subscribers(key):
+                            announcements.setdefault(thread_id, {}).update(dict.fromkeys(matching, plan['params']['query']))
+                await gather(*[self.announce(threads[thread_id], new_ads) for thread_id, new_ads in announcements.items() if new_ads])
+                subscriptions = sum(len(self.queries[thread_id]['kwargs']) for thread_id in threads)
+                self.logger.info(f'Ran {len(plans)} searches for {subscriptions} subscriptions, saved {subscriptions - len(plans)} requests')
+                await self.parser.save_ads_to_file(polled_at)
                 for id in to_delete:
-                    del self.queries[id]
+                    self.queries.pop(id, None)
                 self.save_queries_to_file()
+                CYCLE_DURATION.observe(monotonic() - started, marketplace='kleinanzeigen')
+                self.freshness.maybe_report(self.logger, Config.FRESHNESS_SLOW_QUERY)
             await aio_sleep(randint(Config.SMOL_EBAY_UPDATE_INTERVAL*0.5, Config.SMOL_EBAY_UPDATE_INTERVAL*1.5))
 
     def cog_unload(self):
         self.worker.cancel()
+        for worker in self.parser.detail_workers:
+            worker.cancel()
+        self.parser.close()
 
 
 async def setup(bot):
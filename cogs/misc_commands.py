@@ -3,15 +3,16 @@ import pickle
 
 from discord.ext import commands
 from discord import app_commands
-from typing import Optional
+from typing import Literal, Optional
 from logging import getLogger
-from traceback import format_exc
 #from aiofile import async_open
 from os import path
 from random import randint
 from asyncio import create_task, sleep as aio_sleep
 from datetime import datetime
 from config import Config
+from cogs.utils.profiling import Profiler
+from metrics import CACHE_SIZE, CYCLE_DURATION, DISCORD_SEND_LATENCY, HTTP_LATENCY, HTTP_REQUESTS, LISTINGS_ANNOUNCED, LISTINGS_NEW, LISTINGS_SEEN, PARSE_DURATION, REQUEST_QUEUE_TIME
 
 class MiscCommands(commands.Cog):
     def __init__(self, bot):
@@ -19,6 +20,7 @@ class MiscCommands(commands.Cog):
         self.logger = getLogger('market_bot.misc')
         self.queries = {}
         self.guild = None
+        self.profiler = Profiler(f'{Config.CACHE_PATH}/profiles')
 
     def _set_essentials(self, session):
         pass
@@ -62,7 +64,133 @@ class MiscCommands(commands.Cog):
             await interaction.response.defer()
             await interaction.channel.purge(limit=amount+1)
         except Exception as e:
-            self.logger.info(f'Failed to purge messages: {format_exc()}')
+            self.logger.info('Failed to purge messages', exc_info=True)
+
+    @app_commands.command(
+        name='pools',
+        description='Show HTTP connection pool statistics'
+    )
+    async def pools(self, interaction: discord.Interaction):
+        lines = []
+        for name, session in self.bot.sessions.items():
+            stats = session.pool_stats()
+            if not stats: # Replayed sessions have no pool
+                continue
+            lines.append(f"**{name}**: {stats['active']}/{stats['limit']} active, {stats['idle']} idle, "
+                         f"{stats['created']} opened (avg {stats['avg_connect']}s), {stats['reused']} reused, "
+                         f"{stats['queued']} waited (avg {stats['avg_wait']}s, max {stats['max_wait']}s)")
+            waiting = ', '.join(f'{lane}: {count}' for lane, count in stats['lanes']['waiting'].items())
+            if waiting:
+                lines.append(f'- queued by priority: {waiting}')
+        await interaction.response.send_message('\n'.join(lines) or 'No pools', ephemeral=True)
+
+    @app_commands.command(
+        name='stats',
+        description='Show polling, parsing and announcing statistics'
+    )
+    async def stats(self, interaction: discord.Interaction):
+        def seconds(histogram, q, **labels):
+            value = histogram.quantile(q, **labels)
+            return '-' if value is None else f'{value:.2f}s'
+
+        CACHE_SIZE.collect()
+        lines = []
+        for marketplace in ('kleinanzeigen', 'ebay'):
+            lines.append(f'**{marketplace}**: {LISTINGS_SEEN.total(marketplace=marketplace)} seen, {LISTINGS_NEW.total(marketplace=marketplace)} new, '
+                         f'{LISTINGS_ANNOUNCED.total(marketplace=marketplace)} announced, {CACHE_SIZE.total(marketplace=marketplace, cache="listings")} cached\n'
+                         f'cycle p50 {seconds(CYCLE_DURATION, 0.5, marketplace=marketplace)} p95 {seconds(CYCLE_DURATION, 0.95, marketplace=marketplace)}, '
+                         f'parse p95 {seconds(PARSE_DURATION, 0.95, marketplace=marketplace, kind="search")}, '
+                         f'send p95 {seconds(DISCORD_SEND_LATENCY, 0.95, marketplace=marketplace)}')
+        statuses = {}
+        for (host, endpoint, status), count in HTTP_REQUESTS.values.items():
+            statuses.setdefault(host, {}).setdefault(status, 0)
+            statuses[host][status] += count
+        for host, counts in statuses.items():
+            text = ', '.join(f'{status}: {count}' for status, count in sorted(counts.items()))
+            lines.append(f'`{host}` {text}, latency p50 {seconds(HTTP_LATENCY, 0.5, host=host)} p95 {seconds(HTTP_LATENCY, 0.95, host=host)}')
+            queued = [f'{lane} {seconds(REQUEST_QUEUE_TIME, 0.95, host=host, priority=lane)}' for lane in ('bid', 'target', 'interactive', 'polling')
+                      if REQUEST_QUEUE_TIME.total(host=host, priority=lane)]
+            if queued:
+                lines.append(f"- queue p95 {', '.join(queued)}")
+        monitor = getattr(self.bot, 'loop_monitor', None)
+        if monitor:
+            lines.append(f'**Event loop**: {monitor.summary()}')
+            for origin, count, total in monitor.top_slow(3):
+                lines.append(f'- slow `{origin[:120]}`: {count}x, {total:.2f}s')
+        for cog in self.bot.cogs.values():
+            freshness = getattr(cog, 'freshness', None)
+            if freshness:
+                lines.append(f'**{freshness.marketplace} freshness**: {freshness.summary()}')
+                for query, stats in freshness.slow_queries(Config.FRESHNESS_SLOW_QUERY, limit=3):
+                    lines.append(f"- slow `{query}`: p95 {stats['p95']:.0f}s over {stats['count']} listings")
+        # Discord caps a message at 2000 characters, the rest goes into follow-ups
+        chunks = self.split_lines(lines)
+        await interaction.response.send_message(chunks[0], ephemeral=True)
+        for chunk in chunks[1:]:
+            await interaction.followup.send(chunk, ephemeral=True)
+
+    @staticmethod
+    def split_lines(lines, limit=1900):
+        chunks = ['']
+        for line in lines:
+            line = line[:limit]
+            if chunks[-1] and len(chunks[-1]) + len(line) + 1 > limit:
+                chunks.append('')
+            chunks[-1] = f'{chunks[-1]}\n{line}' if chunks[-1] else line
+        return chunks
+
+    async def send_report(self, interaction, summary, filepath):
+        text = f'```\n{summary[:1900]}\n```'
+        if filepath:
+            await interaction.followup.send(text, file=discord.File(filepath), ephemeral=True)
+        else:
+            await interaction.followup.send(text, ephemeral=True)
+
+    @app_commands.command(
+        name='profile',
+        description='Profile the bot for a number of seconds'
+    )
+    @app_commands.describe(seconds='How long to profile', mode='sampling is cheap, cprofile traces every call')
+    @app_commands.default_permissions(administrator=True)
+    @app_commands.checks.has_permissions(administrator=True)
+    async def profile(self, interaction: discord.Interaction, seconds: app_commands.Range[int, 1, 300] = 10, mode: Literal['sampling', 'cprofile'] = 'sampling'):
+        if self.profiler.lock.locked():
+            await interaction.response.send_message('Profiler is already running', ephemeral=True)
+            return
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        try:
+            if mode == 'cprofile':
+                summary, filepath = await self.profiler.cprofile(seconds)
+            else:
+                summary, filepath = await self.profiler.sample(seconds)
+            self.logger.info(f'Wrote {mode} profile to {filepath}')
+            await self.send_report(interaction, summary, filepath)
+        except Exception as e:
+            self.logger.exception('Profiling failed')
+            await interaction.followup.send(f'Profiling failed: {e}', ephemeral=True)
+
+    @app_commands.command(
+        name='memory',
+        description='Trace memory allocations and show what grew since the last snapshot'
+    )
+    @app_commands.describe(action='start tracing, take a snapshot diff or stop tracing')
+    @app_commands.default_permissions(administrator=True)
+    @app_commands.checks.has_permissions(administrator=True)
+    async def memory(self, interaction: discord.Interaction, action: Literal['snapshot', 'start', 'stop'] = 'snapshot'):
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        try:
+            if action == 'start':
+                await self.profiler.memory_start()
+                summary, filepath = 'Tracing allocations, take a snapshot to see what grew', None
+            elif action == 'stop':
+                self.profiler.memory_stop()
+                summary, filepath = 'Stopped tracing allocations', None
+            else:
+                summary, filepath = await self.profiler.memory_snapshot()
+            await self.send_report(interaction, summary, filepath)
+        except Exception as e:
+            self.logger.exception('Memory snapshot failed')
+            await interaction.followup.send(f'Memory snapshot failed: {e}', ephemeral=True)
 
             
 async def setup(bot):
@@ -1,13 +1,24 @@
 import asyncio
 import json
 
+from collections import Counter
 from datetime import datetime, timezone
 from random import choices
-from traceback import format_exc
 from string import ascii_letters, digits
-from time import time
+from urllib.parse import urlsplit
+from time import monotonic, perf_counter, time
 from logging import getLogger
 from config import Config
+from cogs.parsers.listing_cache import ListingCache
+from cogs.parsers.listing_store import ListingStore
+from cogs.parsers.seen_index import SeenIndex
+from cogs.parsers.decoding import Decoder
+from cogs.parsers.schemas import EbaySearch, EbayDetails
+from cogs.parsers.listing import EbayListing, parse_price
+from metrics import CACHE_SIZE, CLOCK_OFFSET, LISTINGS_NEW, LISTINGS_SEEN, PARSE_DURATION
+from cogs.parsers.http import body_excerpt
+from cogs.parsers.clock import ServerClock
+from cogs.parsers.priority import Priority
 
 TIMEOUT_PERIOD = 5
 UPDATE_INTERVAL = 500
@@ -15,6 +26,7 @@ UPDATE_INTERVAL = 500
 class BigEbayParser:
     def __init__(self, session):
         self.session = session
+        self.bid_session = session
         self.base_uri = 'https://apisd.ebay.com/experience/'
         self.graph_uri = 'https://apisd.ebay.com/graphql'
         self.item_uri = 'https://www.ebay.de/itm/'
@@ -61,10 +73,22 @@ class BigEbayParser:
                 'Accept': 'application/json'
             }
         }
-        self.cached_ads = {}
-        self.non_announced = []
+        self.seen = SeenIndex(f'{Config.CACHE_PATH}/seen.sqlite3', 'ebay', Config.LISTING_SEEN_MAX_AGE)
+        self.cached_ads = ListingCache(Config.LISTING_CACHE_SIZE, Config.LISTING_CACHE_MAX_AGE, seen_ids=self.seen)
         self.starting_datetime = datetime.now(timezone.utc)
         self.logger = getLogger('market_bot.ebay_parser')
+        self.search_decoder = Decoder(EbaySearch, Config.FAST_JSON)
+        self.details_decoder = Decoder(EbayDetails, Config.FAST_JSON)
+        self.decoder = Decoder(enabled=Config.FAST_JSON)
+        self.parse_errors = Counter()
+        # Auction end times are eBay's, every response from the API host feeds the offset estimate
+        self.clock = ServerClock(Config.CLOCK_WINDOW)
+        if hasattr(session, 'add_clock'):
+            session.add_clock(urlsplit(self.base_uri).hostname, self.clock)
+        CACHE_SIZE.set_function(lambda: len(self.cached_ads), marketplace='ebay', cache='listings')
+        CLOCK_OFFSET.set_function(lambda: self.clock.offset, host=urlsplit(self.base_uri).hostname)
+        self.store = ListingStore(f'{Config.CACHE_PATH}/big_ebay_ads', self.logger, Config.LISTING_STORE_SEGMENT_SIZE, Config.LISTING_STORE_COMPACT_RATIO, Config.LISTING_CACHE_MAX_AGE)
+        self.load_ads_from_file()
         self.BID_OFFSET = 2
         self.INCREASE_BID_BY = 2
 
@@ -76,7 +100,7 @@ class BigEbayParser:
             
 
 
-    async def get_details(self, itemId):
+    async def get_details(self, itemId, priority=Priority.POLLING):
         params = {
             'itemId' : itemId,
             'modules' : 'VLS',
@@ -86,26 +110,35 @@ class BigEbayParser:
             'enableVIM' : 'true',
             'supported_gadget_ux_components' : 'BEST_OFFER_TOOL_TIP,TOOL_TIP_WITH_DISMISS,FIXED_COUPON_BANNER_V3,DRAWER_COUPON_BANNER,REWARDS_ENROLLMENT_MODAL,REWARDS_ACTIVATION_MODAL,REWARDS_REDEMPTION_MODAL,WIDGET_RESPONSE_MODAL,COUPONS_LAYER,EBAY_PLUS_BANNER',
         }
-        async with self.session.get(url=self.get_uri('view_item'), headers=self.get_headers('details'), params=params) as resp:
+        async with self.session.get(url=self.get_uri('view_item'), headers=self.get_headers('details'), params=params, priority=priority) as resp:
             if resp.status == 200:
-                ad = await resp.json()
+                ad = await self.details_decoder.decode(resp)
+                started = perf_counter()
                 listing_prop = ad['modules']['VLS']['listing']
                 startDate = int(datetime.strptime(listing_prop['listingLifecycle']['scheduledStartDate']['value'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp())
                 endDate = int(datetime.strptime(listing_prop['listingLifecycle']['scheduledEndDate']['value'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp())
                 format = listing_prop['format']
                 sid = ad['modules']['SEMANTIC_DATA']['bidPrefetch']['tracking']['eventProperty']['sid'] if format == 'AUCTION' else None
 
-                self.cached_ads[itemId] = {
-                    'title' : listing_prop['title']['content'],
-                    'startDate' : startDate,
-                    'endDate' : endDate,
-                    'sid' : sid,
-                    'isAuction' : True if format == 'AUCTION' else False
-                }
+                listing = self.cached_ads.get(itemId) or EbayListing(id=itemId, title='', price=None, url=f'{self.item_uri}{itemId}')
+                listing.title = listing_prop['title']['content']
+                listing.startDate = startDate
+                listing.endDate = endDate
+                listing.sid = sid
+                listing.isAuction = format == 'AUCTION'
+                self.cached_ads[itemId] = listing
+                PARSE_DURATION.observe(perf_counter() - started, marketplace='ebay', kind='details')
             else:
-                self.logger.error(f'Error during getting details: {await resp.text()}')
+                self.logger.error(f'Error during getting details: {await body_excerpt(resp)}')
 
-    def parse_results(self, query_result, firstTime=False):
+    def parse_results(self, query_result, match=None, query=''):
+        """
+        Returns ids of listings that weren't seen before.
+        `match(price, title)` drops listings nobody asked for before they get cached
+        """
+        new_ads = []
+        seen = 0
+        started = perf_counter()
         if query_result.get('deferred_modules', None):
             listings = {**query_result['deferred_modules'][0], **query_result['modules']}
         else:
@@ -121,47 +154,62 @@ class BigEbayParser:
                                 isTrueResult = True
                     if not isTrueResult:
                         continue
-                    if not itemId in self.cached_ads:
+                    seen += 1
+                    if not self.cached_ads.seen(itemId):
+                        title = item['title']['textSpans'][0]['text']
+                        price = parse_price(item['displayPrice']['value']['value'])
+                        if match and not match(price, title):
+                            continue
                         ended = item.get('ended', False)
                         sellerName = item['__search']['sellerInfo']['text']['textSpans'][0]['text']
                         itemProperties = [x[0] for x in item['itemPropertyOrdering']['DEFAULT']['primary']]
+                        shipping = ''
                         if '__search.freeXDays' in itemProperties:
                             shipping = 'Free Shipping'
                         elif 'logisticsCost' in itemProperties:
                             shipping  = item['logisticsCost']['textSpans'][0]['text']
                         isAuction = 'bidCount' in itemProperties
-                        self.cached_ads[itemId] = {
-                            'title' : item['title']['textSpans'][0]['text'],
-                            'price' : item['displayPrice']['value']['value'],
-                            'isAuction' : isAuction,
-                            'condition' : item['__search']['normalizedCondition']['text'],
-                            'sellerName' : sellerName,
-                            'sellerType' : item['__search']['sellerAccountType']['text'],
-                            'shipping' : shipping,
-                            'img' : item['image']['URL'] if item.get('image') else '',
-                            'url' : f'{self.item_uri}{itemId}',
-                            'userUrl' : f'{self.user_uri}{sellerName.split(" (")[0]}',
-                        }
+                        listing = EbayListing(
+                            id=itemId,
+                            title=title,
+                            price=price,
+                            url=f'{self.item_uri}{itemId}',
+                            img=item['image']['URL'] if item.get('image') else '',
+                            sellerName=sellerName,
+                            isAuction=isAuction,
+                            condition=item['__search']['normalizedCondition']['text'],
+                            sellerType=item['__search']['sellerAccountType']['text'],
+                            shipping=shipping,
+                            userUrl=f'{self.user_uri}{sellerName.split(" (")[0]}',
+                            detected_at=time(),
+                        )
                         if not ended and isAuction:
-                            self.cached_ads[itemId]['buyNow'] = '__search.formatBuyItNow' in itemProperties
-                            self.cached_ads[itemId]['priceSuggestion'] = '__search.formatBestOfferEnabled' in itemProperties
+                            listing.buyNow = '__search.formatBuyItNow' in itemProperties
+                            listing.priceSuggestion = '__search.formatBestOfferEnabled' in itemProperties
                             try:
-                                self.cached_ads[itemId]['endDate'] = int(datetime.strptime(item['displayTime']['value']['value'], '%Y-%m-%dT%H:%M:%S.000Z').replace(tzinfo=timezone.utc).timestamp()),
+                                listing.endDate = int(datetime.strptime(item['displayTime']['value']['value'], '%Y-%m-%dT%H:%M:%S.000Z').replace(tzinfo=timezone.utc).timestamp())
                             except Exception:
                                 pass
-                        if not firstTime:
-                            self.non_announced.append(itemId)
+                        self.cached_ads[itemId] = listing
+                        new_ads.append(itemId)
                 except Exception as e:
-                    self.logger.error(f'Error during parsing: {format_exc()}\n{item}')
+                    # Malformed items are counted, not dumped into the log
+                    self.parse_errors[type(e).__name__] += 1
+                    self.logger.debug(f'Skipping malformed listing {item.get("listingId")}: {e!r}')
+        self.cached_ads.expire()
+        LISTINGS_SEEN.inc(seen, marketplace='ebay', query=query)
+        LISTINGS_NEW.inc(len(new_ads), marketplace='ebay', query=query)
+        PARSE_DURATION.observe(perf_counter() - started, marketplace='ebay', kind='search')
+        return new_ads
 
     async def get_category(self, params):
         suggestedCategory = 0
         suggestedCategoryName = ''
         priceRanges = []
-        async with self.session.get(url=self.get_uri('search'), headers=self.get_headers('search'), params=params) as resp:
+        async with self.session.get(url=self.get_uri('search'), headers=self.get_headers('search'), params=params, priority=Priority.INTERACTIVE) as resp:
             try:
                 if resp.status == 200:
-                    search_data = await resp.json()
+                    search_data = await self.decoder.decode(resp)
                     for group in search_data['deferred_modules'][0]['SEARCH_REFINEMENTS_MODEL_V2']['group']:
                         try:
                             if group.get('paramKey') == '_sacat':
@@ -178,9 +226,9 @@ class BigEbayParser:
                         except Exception:
                             pass
                 else:
-                    self.logger.error(f'Got {resp.status} during search: {await resp.text()}')
+                    self.logger.error(f'Got {resp.status} during search: {await body_excerpt(resp)}')
             except Exception as e:
-                self.logger.error(f'Error on guessCategory search: {format_exc()}')
+                self.logger.exception('Error on guessCategory search')
             
         return suggestedCategory, suggestedCategoryName
 
@@ -264,21 +312,54 @@ class BigEbayParser:
                 params['LH_ItemCondition'] = '|'.join([str(x) for x in condition])
         return params
 
-    async def search_offers(self, params, firstTime):
+    async def search_offers(self, params, match=None):
         try:
             async with self.session.get(url=self.get_uri('search'), headers=self.get_headers('search'), params=params) as resp:
                 try:
                     if resp.status == 200:
-                        data = await resp.json()
-                        self.parse_results(data, firstTime)
+                        data = await self.search_decoder.decode(resp)
+                        return self.parse_results(data, match, params.get('_nkw', ''))
                     else:
-                        self.logger.error(f'Got {resp.status} during search: {await resp.text()}')
+                        self.logger.error(f'Got {resp.status} during search: {await body_excerpt(resp)}')
                 except Exception as e:
-                    self.logger.error(f'Error during search: {format_exc()}')
+                    self.logger.exception('Error during search')
         except Exception as e:
-            self.logger.error(f'{format_exc()}')
+            self.logger.exception('Search request failed')
+        return []
 
-    async def place_bid(self, itemId, price, sid=None, tryOverbid=False):
+    def set_bid_session(self, session):
+        """Dedicated pool for bids, its warm-up responses feed the clock as well"""
+        self.bid_session = session or self.session
+        if session and hasattr(session, 'add_clock'):
+            session.add_clock(urlsplit(self.base_uri).hostname, self.clock)
+
+    async def warm_bid_session(self):
+        """
+        Cheap request over the bid pool, opens its connection or keeps it from idling out.
+        Returns seconds it took to open a new connection, 0 if one was reused, None on failure
+        """
+        created = self.bid_session.pool_stats().get('created', 0)
+        try:
+            async with self.bid_session.request('HEAD', self.base_uri, headers=self.get_headers(), priority=Priority.BID):
+                pass
+        except Exception as e:
+            self.logger.warning(f'Bid connection warm-up failed: {e!r}')
+            return None
+        stats = self.bid_session.pool_stats()
+        return stats['last_connect'] if stats.get('created', 0) > created else 0.0
+
+    async def sync_clock(self, count=5, spacing=0.2):
+        """Cheap requests spread over a second, so one of them lands close to a second boundary of the Date header"""
+        if not hasattr(self.bid_session, 'add_clock'):
+            return None
+        for idx in range(count):
+            if idx:
+                await asyncio.sleep(spacing)
+            await self.warm_bid_session()
+        return self.clock.estimate()
+
+    def prepare_bid(self, itemId, price, sid=None):
+        """Everything for the bid request built ahead of time, the body already serialized"""
         params = {
             'modules_group' : 'POWER_BID_LAYER',
             'ocv' : 0,
@@ -294,7 +375,27 @@ class BigEbayParser:
             'itemId' : itemId,
             'decimalPrecision': 2,
         }
-        async with self.session.post(url=self.get_uri('commit_bid'), headers=self.get_headers('auth'), params=params, json=payload) as resp:
+        return {
+            'itemId' : itemId,
+            'sid' : sid,
+            'url' : self.get_uri('commit_bid'),
+            'headers' : self.get_headers('auth'),
+            'params' : params,
+            'data' : json.dumps(payload).encode('utf8'),
+            'sent_at' : None,
+            'connect' : None,
+        }
+
+    async def place_bid(self, itemId, price, sid=None, tryOverbid=False):
+        return await self.send_bid(self.prepare_bid(itemId, price, sid), tryOverbid)
+
+    async def send_bid(self, bid, tryOverbid=False):
+        itemId = bid['itemId']
+        created = self.bid_session.pool_stats().get('created', 0)
+        bid['sent_at'] = monotonic()
+        async with self.bid_session.post(url=bid['url'], headers=bid['headers'], params=bid['params'], data=bid['data'], priority=Priority.BID) as resp:
+            stats = self.bid_session.pool_stats()
+            bid['connect'] = stats['last_connect'] if stats.get('created', 0) > created else 0.0
             try:
                 if resp.status == 200:
                     data = await resp.json()
@@ -307,13 +408,13 @@ class BigEbayParser:
                         text = f'Outbid for {currentPrice}€ for {itemId} by {bidder}'
                         if tryOverbid:
                             newAmount = float(currentPrice) + self.INCREASE_BID_BY
-                            return await self.place_bid(itemId, newAmount, sid)
+                            return await self.place_bid(itemId, newAmount, bid['sid'])
                     self.logger.info(text)
                     return isHighBidder, text
                 else:
-                    print(await resp.text())
+                    self.logger.error(f'Got {resp.status} on bid: {await body_excerpt(resp)}')
             except Exception as e:
-                self.logger.error(f'Error on bid {format_exc()}')
+                self.logger.exception('Error on bid')
             return False, ''
 
     async def watchlist(self, itemId, follow=True):
@@ -349,7 +450,7 @@ class BigEbayParser:
                     }
                 }
             }
-        async with self.session.post(self.graph_uri, headers=self.get_headers('watchlist'), json=payload) as resp:
+        async with self.session.post(self.graph_uri, headers=self.get_headers('watchlist'), json=payload, priority=Priority.INTERACTIVE) as resp:
             if resp.status == 200:
                 data = await resp.json()
                 if follow:
@@ -358,8 +459,24 @@ class BigEbayParser:
                     done = (data['data']['result']['__typename'] == 'StopWatchingOnListSuccess')
                 return done
             else:
-                print(await resp.text())
+                self.logger.error(f'Got {resp.status} on watchlist: {await body_excerpt(resp)}')
+
+    async def save_ads_to_file(self):
+        # Only listings added or changed since last save are appended
+        await self.seen.flush()
+        await self.store.append({itemId : ad.to_dict() for itemId, ad in self.cached_ads.pop_dirty().items()})
+
+    def close(self):
+        self.store.close()
+        self.seen.close()
+
+    def load_ads_from_file(self):
+        for itemId, ad in self.store.load().items():
+            self.cached_ads[itemId] = EbayListing.from_dict(ad, itemId)
+        self.cached_ads.pop_dirty()
+        self.logger.debug(f'Read data from file, store: {self.store.stats()}')
 
     async def getAuction(self, itemId):
-        await self.get_details(itemId)
+        # Fetched for targeting, goes ahead of background polling
+        await self.get_details(itemId, Priority.TARGET)
         return self.cached_ads.get(itemId, None)
\ No newline at end of file
@@ -0,0 +1,60 @@
+from collections import deque
+from email.utils import parsedate_to_datetime
+from time import time
+
+
+class ServerClock:
+    """
+    Offset of an upstream server's clock against ours (server - local) from the `Date` headers of its responses.
+    The header only has whole seconds and was written somewhere between sending the request and receiving the
+    response, so every response bounds the offset to an interval. The estimate is the middle of the intersection
+    of recent intervals and the uncertainty half of its width, responses around a second boundary narrow it most.
+    """
+    def __init__(self, window=30*60, max_samples=200):
+        self.window = window
+        self.samples = deque(maxlen=max_samples) # (received at, low, high, round trip)
+
+    def observe(self, date_header, sent, received):
+        if not date_header:
+            return
+        try:
+            server = parsedate_to_datetime(date_header).timestamp()
+        except (TypeError, ValueError):
+            return
+        self.samples.append((received, server - received, server + 1 - sent, received - sent))
+
+    def bounds(self):
+        """(low, high, samples used) or None, walking from the newest sample until one contradicts the rest"""
+        oldest = time() - self.window
+        while self.samples and self.samples[0][0] < oldest:
+            self.samples.popleft()
+        low, high, used = float('-inf'), float('inf'), 0
+        for _, sample_low, sample_high, _ in reversed(self.samples):
+            # Older samples disagreeing with newer ones mean one of the clocks was stepped
+            if max(low, sample_low) > min(high, sample_high):
+                break
+            low, high, used = max(low, sample_low), min(high, sample_high), used + 1
+        return (low, high, used) if used else None
+
+    @property
+    def offset(self):
+        bounds = self.bounds()
+        return (bounds[0] + bounds[1]) / 2 if bounds else 0.0
+
+    def estimate(self):
+        bounds = self.bounds()
+        if not bounds:
+            return None
+        low, high, used = bounds
+        return {
+            'offset' : (low + high) / 2,
+            'uncertainty' : (high - low) / 2,
+            'samples' : used,
+            'rtt' : min(x[3] for x in list(self.samples)[-used:]),
+        }
+
+    def describe(self):
+        estimate = self.estimate()
+        if not estimate:
+            return 'no estimate yet'
+        return f"{estimate['offset']:+.3f}s ±{estimate['uncertainty']*1000:.0f}ms from {estimate['samples']} responses, best round trip {estimate['rtt']*1000:.0f}ms"
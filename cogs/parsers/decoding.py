@@ -0,0 +1,41 @@
+import json
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Decoder:
+    """
+    JSON decoder for one kind of response. With msgspec installed and a schema given only fields
+    declared in the schema are built, otherwise the full tree is decoded with orjson if available.
+    Disabled decoders keep the plain `resp.json()` path.
+    """
+    def __init__(self, schema=None, enabled=True):
+        self.enabled = enabled
+        self.typed = msgspec.json.Decoder(schema) if enabled and msgspec and schema is not None else None
+        self.fallbacks = 0
+
+    async def decode(self, resp):
+        if not self.enabled:
+            return await resp.json()
+        return self.loads(await resp.read())
+
+    def loads(self, body):
+        if self.typed:
+            try:
+                return self.typed.decode(body)
+            except msgspec.ValidationError:
+                # Upstream changed its shape, keep working on the full tree
+                self.fallbacks += 1
+        if orjson:
+            return orjson.loads(body)
+        if msgspec:
+            return msgspec.json.decode(body)
+        return json.loads(body)
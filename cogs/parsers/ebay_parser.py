@@ -1,22 +1,30 @@
 import asyncio
 import json
 
+from collections import Counter
 from os import name, path
 from datetime import datetime, timezone
-from time import time
+from time import perf_counter, time
 from html import unescape
-from traceback import format_exc
 from logging import getLogger
 from config import Config
+from cogs.parsers.listing_cache import ListingCache
+from cogs.parsers.listing_store import ListingStore
+from cogs.parsers.seen_index import SeenIndex
+from cogs.parsers.rate_limit import TokenBucket
+from cogs.parsers.priority import Priority
+from cogs.parsers.decoding import Decoder
+from cogs.parsers.schemas import KleinanzeigenSearch, KleinanzeigenDetails
+from cogs.parsers.listing import KleinanzeigenListing, parse_price
+from metrics import CACHE_SIZE, LISTINGS_NEW, LISTINGS_SEEN, PARSE_DURATION
 
-TIMEOUT_PERIOD = 5
 
 class EbayParser:
 	def __init__(self, session):
 		self.session = session
 		self.base_uri = 'https://api.kleinanzeigen.de/api/'
 		self.base_testuri = 'https://127.0.0.1'
-		self.filepath = f'{Config.CACHE_PATH}/ebay_ads.json'
+		self.filepath = f'{Config.CACHE_PATH}/ebay_ads.json' # Legacy full dump, imported into the store once
 
 		self.base_headers = {
 			'Accept': '*/*',
@@ -29,13 +37,26 @@ class EbayParser:
 			'X-ECG-VER': '1.16',
 			'Authorization' : f'Basic {Config.SMOL_EBAY_KEYS.KEY}',
 		}
-		self.cached_ads = {}
-		self.non_announced = []
-		self.starting_datetime = datetime.now(timezone.utc)
+		self.seen = SeenIndex(f'{Config.CACHE_PATH}/seen.sqlite3', 'kleinanzeigen', Config.LISTING_SEEN_MAX_AGE)
+		self.cached_ads = ListingCache(Config.LISTING_CACHE_SIZE, Config.LISTING_CACHE_MAX_AGE, seen_ids=self.seen)
+		# Listings published while the bot was down are still new, on the very first run only fresh ones are
+		self.starting_timestamp = self.seen.last_polled() or int(time())
 		self.logger = getLogger('market_bot.kleinanzeigen_parser')
-		#self.load_ads_from_file()
+		self.search_decoder = Decoder(KleinanzeigenSearch, Config.FAST_JSON)
+		self.details_decoder = Decoder(KleinanzeigenDetails, Config.FAST_JSON)
+		self.decoder = Decoder(enabled=Config.FAST_JSON)
+		self.parse_errors = Counter()
+		# Details and view counters are fetched by background workers under a shared budget
+		self.detail_bucket = TokenBucket(Config.SMOL_EBAY_DETAIL_RATE, Config.SMOL_EBAY_DETAIL_BURST)
+		self.detail_queue = asyncio.Queue()
+		self.detail_results = {} # id : future resolved once details are in
+		self.detail_workers = []
+		CACHE_SIZE.set_function(lambda: len(self.cached_ads), marketplace='kleinanzeigen', cache='listings')
+		CACHE_SIZE.set_function(lambda: self.detail_queue.qsize(), marketplace='kleinanzeigen', cache='detail_queue')
+		self.store = ListingStore(f'{Config.CACHE_PATH}/ebay_ads', self.logger, Config.LISTING_STORE_SEGMENT_SIZE, Config.LISTING_STORE_COMPACT_RATIO, Config.LISTING_CACHE_MAX_AGE)
+		self.load_ads_from_file()
 
-	async def search(self, query, city=0, radius=25, size=30, maxPrice=350, minPrice=100, exclude=''):
+	async def search(self, query, city=0, radius=25, size=30, maxPrice=None, minPrice=None, exclude='', match=None):
 		headers = self.base_headers.copy()
 		headers['X-ECG-IN'] = 'ad-address,ad-source-id,ad-status,ad-type,ads-search-suggested-category,attributes,category,displayoptions,features-active,id,link,locations.location.id,locations.location.regions.region.localized-name,medias.media.media-link,otherAttributes.partner-contact-display-name,phone,pictures,poster-type,price,search-distance,seller-account-type,start-date-time,title,user-id,user-rating'
 		headers['X-EBAYK-USECASE'] = 'results-search'
@@ -45,20 +66,23 @@ class EbayParser:
 			'limitTotalResultCount' : 'true',
 			'pictureRequired' : 'true',
 			'locationId' : city,
-			'maxPrice' : maxPrice,
-			'minPrice' : minPrice,
 			'q' : query,
 			'size' : size,
 		}
+		if maxPrice is not None:
+			filters['maxPrice'] = maxPrice
+		if minPrice is not None:
+			filters['minPrice'] = minPrice
 		if city:
 			filters['distance'] = radius
 		url = self.base_uri + 'ads.json'
 		async with self.session.get(url, headers=headers, params=filters) as response:
 			if response.status == 200:
-				content = await response.json()
-				await self.parse_search_result(content, exclude=exclude)
+				content = await self.search_decoder.decode(response)
+				return await self.parse_search_result(content, exclude=exclude, match=match, query=query)
 			else:
 				self.logger.error(f'Failed getting search results: {response.status}')
+		return []
 
 	async def search_by_user(self, store_id, size=30):
 		headers = self.base_headers.copy()
@@ -74,126 +98,183 @@ class EbayParser:
 		url = self.base_uri + 'ads.json'
 		async with self.session.get(url, headers=headers, params=filters) as response:
 			if response.status == 200:
-				content = await response.json()
-				await self.parse_search_result(content, False)
+				content = await self.search_decoder.decode(response)
+				return await self.parse_search_result(content, False)
 			else:
 				self.logger.error(f'Failed getting search results: {response.status}')
+		return []
 
-	async def parse_search_result(self, result, get_detailed=True, exclude=''):
+	async def parse_search_result(self, result, get_detailed=True, exclude='', match=None, query=''):
+		"""
+		Returns ids of listings from this result that are new, so concurrent searches never share a result set.
+		Their details are queued for enrichment, wait for each with `enriched(id)` before announcing.
+		`match(price, title)` drops listings nobody asked for before they get cached or detailed
+		"""
+		new_ads = []
+		started = perf_counter()
 		searchOptions = result['searchOptions']
 		if not 'ad' in result['{http://www.ebayclassifiedsgroup.com/schema/ad/v1}ads']['value'].keys():
-			return
+			return new_ads
 		ads = result['{http://www.ebayclassifiedsgroup.com/schema/ad/v1}ads']['value']['ad']
+		LISTINGS_SEEN.inc(len(ads), marketplace='kleinanzeigen', query=query)
 		for ad in ads:
-			price = ad['price']['amount'].get('value', '')
-			price_vb = 'VB' if ad['price']['price-type'].get('value', '') == 'PLEASE_CONTACT' else ''
-			title = ad['title']['value']
-			state = ad['locations']['location'][0]['regions']['region'][0]['localized-name'].get('value', '')
-			try:
-				address_data = {k:v.get('value', '') for k, v in ad['ad-address'].items()}
-				address_text = '{} {}, {}'.format(address_data['zip-code'], address_data['state'], state)
-			except Exception as e:
-				address_text = 'No address'
-				self.logger.error(f'Error getting address data, {e}, {ad["ad-address"]}')
-			distance_in_km = None
-			try:
-				if 'search-distance' in ad.keys():
-					distance_data = {k:v.get('value', '') for k, v in ad['search-distance'].items()}
-					distance_in_km = distance_data['display-distance']
-			except Exception as e:
-				self.logger.error(f'Error getting distance data, {e}')
-			status = ad['ad-status']
-			publish_date = datetime.strptime(ad['start-date-time']['value'], '%Y-%m-%dT%H:%M:%S.%f%z')
-			versand = False
-			try:
-				for value in ad['attributes']['attribute']:
-					if value.get('localized-tag', '') == 'Versand möglich':
-						versand = True
-						break
-			except Exception:
-				pass
-			safe_payment = True if ad['displayoptions']['secure-payment-possible'].get('value', '') == 'true' else False
-			link = ad['link'][1]['href']
 			try:
-				img = ad['pictures']['picture'][0]['link'][2]['href']
+				id, listing = self.parse_ad(ad)
 			except Exception as e:
-				img = None
-			id = ad['id']
-			# diff = time.time() - publish_date
-			# ago_text = utcnow().shift(seconds=-diff).humanize()
-			if exclude and exclude.lower() in title.lower():
+				# Malformed ads are counted, not dumped into the log
+				self.parse_errors[type(e).__name__] += 1
+				self.logger.debug(f'Skipping malformed ad {ad.get("id")}: {e!r}')
+				continue
+			if exclude and exclude.lower() in listing.title.lower():
+				continue
+			if match and not match(listing.price, listing.title):
 				continue
 
-			if not id in self.cached_ads.keys() and publish_date > self.starting_datetime:
-				self.cached_ads[id] = {
-						'title' : title,
-						'price' : price,
-						'vb' : price_vb,
-						'address' : address_text,
-						'distance_in_km' : distance_in_km,
-						'status' : status,
-						'publish_date' : publish_date,
-						'state' : state,
-						'versand' : versand,
-						'safe_payment' : safe_payment,
-						'link' : link,
-						'img' : img,
-					}
+			if not self.cached_ads.seen(id) and listing.publish_date > self.starting_timestamp:
+				listing.detected_at = time()
+				self.cached_ads[id] = listing
 				if get_detailed:
-					self.logger.info(f'Getting details for {title}')
+					self.enrich(id)
+					new_ads.append(id)
+		LISTINGS_NEW.inc(len(new_ads), marketplace='kleinanzeigen', query=query)
+		PARSE_DURATION.observe(perf_counter() - started, marketplace='kleinanzeigen', kind='search')
+		return new_ads
+
+	def parse_ad(self, ad):
+		price = parse_price(ad['price']['amount'].get('value', None))
+		price_vb = 'VB' if ad['price']['price-type'].get('value', '') == 'PLEASE_CONTACT' else ''
+		title = ad['title']['value']
+		state = ad['locations']['location'][0]['regions']['region'][0]['localized-name'].get('value', '')
+		try:
+			address_data = {k:v.get('value', '') for k, v in ad['ad-address'].items()}
+			address_text = '{} {}, {}'.format(address_data['zip-code'], address_data['state'], state)
+		except Exception as e:
+			address_text = 'No address'
+			self.logger.error(f'Error getting address data of {ad.get("id")}, {e!r}')
+		distance_in_km = None
+		try:
+			if 'search-distance' in ad.keys():
+				distance_data = {k:v.get('value', '') for k, v in ad['search-distance'].items()}
+				distance_in_km = distance_data['display-distance']
+		except Exception as e:
+			self.logger.error(f'Error getting distance data, {e}')
+		status = ad['ad-status'].get('value', '') if isinstance(ad['ad-status'], dict) else str(ad['ad-status'])
+		publish_date = int(datetime.strptime(ad['start-date-time']['value'], '%Y-%m-%dT%H:%M:%S.%f%z').timestamp())
+		versand = False
+		try:
+			for value in ad['attributes']['attribute']:
+				if value.get('localized-tag', '') == 'Versand möglich':
+					versand = True
+					break
+		except Exception:
+			pass
+		safe_payment = True if ad['displayoptions']['secure-payment-possible'].get('value', '') == 'true' else False
+		link = ad['link'][1]['href']
+		try:
+			img = ad['pictures']['picture'][0]['link'][2]['href']
+		except Exception as e:
+			img = None
+		id = ad['id']
+		return id, KleinanzeigenListing(
+			id=id,
+			title=title,
+			price=price,
+			url=link,
+			img=img,
+			vb=price_vb,
+			address=address_text,
+			distance_in_km=distance_in_km,
+			status=status,
+			publish_date=publish_date,
+			state=state,
+			versand=versand,
+			safe_payment=safe_payment,
+		)
+
+	def enrich(self, id):
+		if not self.detail_workers:
+			self.detail_workers = [asyncio.create_task(self.detail_worker()) for _ in range(Config.SMOL_EBAY_DETAIL_WORKERS)]
+		if id not in self.detail_results:
+			self.detail_results[id] = asyncio.get_running_loop().create_future()
+			self.detail_queue.put_nowait(id)
+
+	async def enriched(self, id):
+		"""Waits for listing details, returns True if listing is complete enough to be announced"""
+		future = self.detail_results.get(id, None)
+		if future:
+			await asyncio.shield(future)
+		ad = self.cached_ads.get(id)
+		return bool(ad and ad.description)
+
+	async def detail_worker(self):
+		while True:
+			id = await self.detail_queue.get()
+			try:
+				if id in self.cached_ads:
+					self.logger.info(f'Getting details for {self.cached_ads[id].title}')
 					await self.get_single_ad(id)
-					await asyncio.sleep(TIMEOUT_PERIOD)
-				if self.cached_ads[id].get('description', None):
-					self.non_announced.append(id)
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				self.logger.exception(f'Failed to enrich {id}')
+			finally:
+				future = self.detail_results.get(id, None)
+				if future and not future.done():
+					future.set_result(None)
+				# Keep the result around for a while, every thread subscribed to the listing waits on it
+				asyncio.get_running_loop().call_later(300, self.detail_results.pop, id, None)
+				self.detail_queue.task_done()
 
 	async def get_single_ad(self, id):
 		headers = self.base_headers.copy()
 		headers['X-EBAYK-USECASE'] = 'vip'
 		headers['X-ECG-IN'] = 'ad-address,ad-external-reference-id,ad-guid,ad-source-id,ad-status,ad-type,attributes,buy-now,category,contact-name,contact-name-initials,description,displayoptions,documents,features-active,id,imprint,link,locations.location.id,locations.location.regions.region.localized-name,medias,otherAttributes,partnership,phone,pictures,poster-type,price,search-distance,seller-account-type,shipping-options,start-date-time,store-id,title,user-id,user-rating,user-since-date-time,userBadges'
 		url = self.base_uri + f'ads/{id}.json'
+		await self.detail_bucket.acquire()
 		async with self.session.get(url, headers=headers) as response:
 			if response.status == 200:
-				content = await response.json()
+				content = await self.details_decoder.decode(response)
 				await self.parse_ad_details(content)
 			else:
 				self.logger.error('Failed to retrieve ad details')
 
 	async def parse_ad_details(self, result):
+		started = perf_counter()
 		ad = result['{http://www.ebayclassifiedsgroup.com/schema/ad/v1}ad']['value']
 		desc = unescape(ad['description'].get('value', '')).replace('<br />', '\n')
 		name = ad['contact-name']['value']
 		userId = ad['user-id']['value']
 		averageRating = None
 		if 'user-rating' in ad.keys():
-			averageRating = ad['user-rating']['averageRating'].get('value', None)
+			averageRating = parse_price(ad['user-rating']['averageRating'].get('value', None))
 		userScore = {}
 		if 'userBadges' in ad.keys():
 			for badge in ad['userBadges']['badges']: # ['rating', 'friendliness', 'reliability', 'replySpeed', 'followers']
 				userScore[badge['name']] = badge['level'] if badge['value'] == '' else badge['value']
 		accountCreated = datetime.strptime(ad['user-since-date-time']['value'], '%Y-%m-%dT%H:%M:%S.%f%z')
-		accountCreated_text = accountCreated.strftime('%Y-%m-%d %H:%M:%S')
 		id = ad['id']
-		self.cached_ads[id].update({
-			'description' : desc,
-			'sellerName' : name,
-			'averageRating' : averageRating,
-			'userScore' : userScore,
-			'accountCreated' : accountCreated,
-			'userId' : userId,
-			'lastUpdated' : int(time())
-			})
+		listing = self.cached_ads[id]
+		listing.description = desc
+		listing.sellerName = name
+		listing.averageRating = averageRating
+		listing.userScore = userScore
+		listing.accountCreated = int(accountCreated.timestamp())
+		listing.userId = userId
+		listing.lastUpdated = int(time())
+		self.cached_ads.mark_dirty(id)
+		PARSE_DURATION.observe(perf_counter() - started, marketplace='kleinanzeigen', kind='details')
 		await self.get_view_counter(id, userId)
 
 	async def get_view_counter(self, id, userId):
 		headers = self.base_headers.copy()
 		data = {'userId' : userId}
 		url = self.base_uri + f'v2/counters/ads/vip/{id}'
+		await self.detail_bucket.acquire()
 		async with self.session.post(url, headers=headers, json=data) as response:
 			if response.status == 200:
-				content = await response.json()
-				self.cached_ads[id].update({
-					'views' : content['value']
-					})
+				content = await self.decoder.decode(response)
+				self.cached_ads[id].views = content['value']
+				self.cached_ads.mark_dirty(id)
 			else:
 				self.logger.error('Failed to retrieve view counter')
 
@@ -205,7 +286,7 @@ class EbayParser:
 			'depth' : 1,
 			'q' : query,
 		}
-		async with self.session.get(url, headers=headers, params=params) as response:
+		async with self.session.get(url, headers=headers, params=params, priority=Priority.INTERACTIVE) as response:
 			if response.status == 200:
 				content = await response.json()
 				try:
@@ -232,14 +313,27 @@ class EbayParser:
 				self.logger.error('Failed getting cities list')
 			return '13819'
 
-	async def save_ads_to_file(self):
-		with open(self.filepath, 'w', encoding='utf8') as f:
-			json.dump(self.cached_ads, f, indent = 2, default=str)
-		self.logger.debug('Wrote data to file')
+	async def save_ads_to_file(self, polled_at=None):
+		# Only listings added or changed since last save are appended
+		await self.seen.flush(polled_at)
+		self.cached_ads.expire(force=True)
+		await self.store.append({id : ad.to_dict() for id, ad in self.cached_ads.pop_dirty().items()})
+		self.logger.debug(f'Wrote data to file, cache: {self.cached_ads.stats()}, store: {self.store.stats()}')
 
+	def close(self):
+		self.store.close()
+		self.seen.close()
 
 	def load_ads_from_file(self):
-		if path.isfile(self.filepath):
+		listings = self.store.load()
+		imported = False
+		if not listings and path.isfile(self.filepath):
 			with open(self.filepath, 'r', encoding='utf8') as f:
-				self.cached_ads = json.load(f)
-			self.logger.debug('Read data from file')
+				listings = json.load(f)
+			imported = True
+			self.logger.info(f'Importing {len(listings)} listings from {self.filepath}')
+		for id, ad in listings.items():
+			self.cached_ads[id] = KleinanzeigenListing.from_dict(ad, id)
+		if not imported: # Stored listings don't need to be written again
+			self.cached_ads.pop_dirty()
+		self.logger.debug('Read data from file')
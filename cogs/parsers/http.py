@@ -0,0 +1,142 @@
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from asyncio import TimeoutError
+from contextlib import asynccontextmanager
+from re import compile
+from time import monotonic, time
+from urllib.parse import urlsplit
+from metrics import HTTP_LATENCY, HTTP_REQUESTS, REQUEST_QUEUE_TIME
+from cogs.parsers.priority import Priority, PriorityGate
+
+# Listing ids in paths would give every listing its own series
+ID_PATTERN = compile(r'\d{3,}')
+
+
+def endpoint_labels(url):
+    parts = urlsplit(str(url))
+    return parts.hostname or '', ID_PATTERN.sub('{id}', parts.path)
+
+
+async def body_excerpt(resp, limit=300):
+    """Start of a response body for error logs, whole pages don't belong there"""
+    text = await resp.text(errors='replace')
+    return text if len(text) <= limit else f'{text[:limit]}... ({len(text)} chars)'
+
+
+class PoolStats:
+    """Collects connection pool timings through aiohttp tracing"""
+    def __init__(self):
+        self.queued = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.created = 0
+        self.create_total = 0.0
+        self.create_last = 0.0
+        self.reused = 0
+
+    def trace_config(self):
+        trace = TraceConfig()
+        trace.on_connection_queued_start.append(self._queued_start)
+        trace.on_connection_queued_end.append(self._queued_end)
+        trace.on_connection_create_start.append(self._create_start)
+        trace.on_connection_create_end.append(self._create_end)
+        trace.on_connection_reuseconn.append(self._reused)
+        return trace
+
+    async def _queued_start(self, session, ctx, params):
+        ctx.queued_at = monotonic()
+
+    async def _queued_end(self, session, ctx, params):
+        wait = monotonic() - ctx.queued_at
+        self.queued += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    async def _create_start(self, session, ctx, params):
+        ctx.create_at = monotonic()
+
+    async def _create_end(self, session, ctx, params):
+        self.create_last = monotonic() - ctx.create_at
+        self.created += 1
+        self.create_total += self.create_last
+
+    async def _reused(self, session, ctx, params):
+        self.reused += 1
+
+    def stats(self, connector):
+        return {
+            'active' : len(connector._acquired),
+            'idle' : sum(len(x) for x in connector._conns.values()),
+            'limit' : connector.limit,
+            'created' : self.created,
+            'reused' : self.reused,
+            'avg_connect' : round(self.create_total / self.created, 3) if self.created else 0,
+            'last_connect' : round(self.create_last, 3),
+            'queued' : self.queued,
+            'avg_wait' : round(self.wait_total / self.queued, 3) if self.queued else 0,
+            'max_wait' : round(self.wait_max, 3),
+        }
+
+
+def make_session(pool, limit=20, limit_per_host=10, keepalive=60, dns_ttl=300, timeout=30, connect_timeout=10):
+    """ClientSession with its own tuned connector, keep-alive and DNS cache"""
+    connector = TCPConnector(limit=limit, limit_per_host=limit_per_host, keepalive_timeout=keepalive, ttl_dns_cache=dns_ttl, use_dns_cache=True)
+    return ClientSession(
+        connector=connector,
+        timeout=ClientTimeout(total=timeout, connect=connect_timeout),
+        trace_configs=[pool.trace_config()],
+        trust_env=True
+    )
+
+
+class LimitedSession:
+    """
+    Drop-in wrapper around a ClientSession for the parsers: every request first waits for
+    the budget of its host and reports the response status back, so limiters can back off.
+    Requests carry a `priority`, both the host budget and the connections of the pool go to
+    the highest waiting class first and keep `reserved` connections free for higher classes.
+    """
+    def __init__(self, session, limiters, pool=None, reserved=None):
+        self.session = session
+        self.limiters = limiters
+        self.pool = pool
+        self.gate = PriorityGate(session.connector.limit or None, reserved)
+        self.clocks = {} # host : ServerClock fed with every response from it
+
+    def add_clock(self, host, clock):
+        self.clocks[host] = clock
+
+    def pool_stats(self):
+        return {**self.pool.stats(self.session.connector), 'lanes' : self.gate.stats()} if self.pool else {}
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    @asynccontextmanager
+    async def request(self, method, url, priority=Priority.POLLING, **kwargs):
+        limiter = self.limiters.for_url(url)
+        host, endpoint = endpoint_labels(url)
+        queued = monotonic()
+        await limiter.acquire(priority)
+        async with self.gate.slot(priority):
+            REQUEST_QUEUE_TIME.observe(monotonic() - queued, host=host, priority=priority.name.lower())
+            responded = False
+            started = monotonic()
+            sent_at = time()
+            try:
+                async with self.session.request(method, url, **kwargs) as resp:
+                    responded = True
+                    HTTP_LATENCY.observe(monotonic() - started, host=host, endpoint=endpoint)
+                    if host in self.clocks:
+                        self.clocks[host].observe(resp.headers.get('Date'), sent_at, time())
+                    HTTP_REQUESTS.inc(host=host, endpoint=endpoint, status=resp.status)
+                    limiter.feedback(resp.status, resp.headers.get('Retry-After'))
+                    yield resp
+            except (OSError, TimeoutError):
+                # Connection failures count as overload too
+                if not responded:
+                    HTTP_REQUESTS.inc(host=host, endpoint=endpoint, status='error')
+                    limiter.slow_down()
+                raise
@@ -0,0 +1,106 @@
+from dataclasses import dataclass, field, fields
+from datetime import datetime
+from typing import Any, Optional
+
+
+def parse_price(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        value = str(value).replace('€', '').replace('EUR', '').strip()
+        if ',' in value:
+            value = value.replace('.', '').replace(',', '.')
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_timestamp(value):
+    """Epoch seconds from an int, a datetime or an ISO string, as stored by older versions"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, (list, tuple)): # endDate used to be stored as a one element tuple
+        return to_timestamp(value[0]) if value else None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp())
+
+
+@dataclass(slots=True)
+class Listing:
+    """Fields every marketplace has. Prices are floats, None when upstream doesn't give a number"""
+    id: Any
+    title: str
+    price: Optional[float]
+    url: str
+    img: Optional[str] = None
+    sellerName: str = ''
+    detected_at: Optional[float] = None # When we first saw it, for freshness tracking
+
+    @property
+    def price_text(self):
+        if self.price is None:
+            return '?'
+        return f'{self.price:.0f}' if self.price.is_integer() else f'{self.price:.2f}'
+
+    def to_dict(self):
+        return {f.name : getattr(self, f.name) for f in fields(self)}
+
+    @classmethod
+    def from_dict(cls, data, id=None):
+        data = dict(data)
+        if id is not None:
+            data['id'] = id
+        if 'link' in data: # Kleinanzeigen listings used to call it link
+            data.setdefault('url', data.pop('link'))
+        data['price'] = parse_price(data.get('price'))
+        for name in cls.TIMESTAMPS:
+            if name in data:
+                data[name] = to_timestamp(data[name])
+        names = {f.name for f in fields(cls)}
+        return cls(**{k : v for k, v in data.items() if k in names})
+
+    TIMESTAMPS = ()
+
+
+@dataclass(slots=True)
+class KleinanzeigenListing(Listing):
+    vb: str = ''
+    address: str = ''
+    distance_in_km: Optional[str] = None
+    status: str = ''
+    publish_date: int = 0
+    state: str = ''
+    versand: bool = False
+    safe_payment: bool = False
+    # Filled by enrichment
+    description: Optional[str] = None
+    averageRating: Optional[float] = None
+    userScore: dict = field(default_factory=dict)
+    accountCreated: Optional[int] = None
+    userId: Optional[str] = None
+    lastUpdated: Optional[int] = None
+    views: Optional[int] = None
+
+    TIMESTAMPS = ('publish_date', 'accountCreated', 'lastUpdated')
+
+
+@dataclass(slots=True)
+class EbayListing(Listing):
+    isAuction: bool = False
+    condition: str = ''
+    sellerType: str = ''
+    shipping: str = ''
+    userUrl: str = ''
+    buyNow: bool = False
+    priceSuggestion: bool = False
+    # Auctions only, filled from search or details
+    startDate: Optional[int] = None
+    endDate: Optional[int] = None
+    sid: Optional[str] = None
+
+    TIMESTAMPS = ('startDate', 'endDate')
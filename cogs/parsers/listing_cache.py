@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from time import time
+
+
+class SeenIds:
+    """Compact FIFO record of listing ids, keeps deduplication working after a listing left the cache"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._ids = {}
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, key):
+        if key in self._ids:
+            return
+        self._ids[key] = None
+        if len(self._ids) > self.max_size:
+            del self._ids[next(iter(self._ids))]
+
+
+class ListingCache:
+    """
+    Bounded listing cache with LRU eviction by size and expiry by age or by auction end date.
+    Ids of evicted listings stay in `seen_ids`, use `seen(key)` for deduplication and `in` for lookups.
+    `seen_ids` can be any set-like with `add`, e.g. a persistent SeenIndex.
+    """
+    def __init__(self, max_size, max_age, seen_size=None, expire_interval=60, now=time, seen_ids=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.expire_interval = expire_interval
+        self.now = now
+        self.last_expired = now()
+        self.seen_ids = seen_ids if seen_ids is not None else SeenIds(seen_size or max_size * 10)
+        self._data = OrderedDict() # key : (value, added_at)
+        self._dirty = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data and not self._expired(key)
+
+    def __iter__(self):
+        return iter(list(self._data.keys()))
+
+    def __getitem__(self, key):
+        if key in self:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key][0]
+        self.misses += 1
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        added_at = self._data[key][1] if key in self._data else self.now()
+        self._data[key] = (value, added_at)
+        self._data.move_to_end(key)
+        self._dirty[key] = None
+        self.seen_ids.add(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def mark_dirty(self, key):
+        """Flags a listing that was changed in place, so it gets persisted again"""
+        if key in self._data:
+            self._dirty[key] = None
+
+    def pop_dirty(self):
+        """Returns listings added or changed since last call that are still cached"""
+        dirty = {key : self._data[key][0] for key in self._dirty if key in self._data}
+        self._dirty = {}
+        return dirty
+
+    def seen(self, key):
+        return key in self._data or key in self.seen_ids
+
+    def items(self):
+        return [(k, v) for k, (v, _) in self._data.items()]
+
+    def values(self):
+        return [v for v, _ in self._data.values()]
+
+    def _expired(self, key):
+        value, added_at = self._data[key]
+        now = self.now()
+        if self.max_age and now - added_at > self.max_age:
+            return True
+        endDate = getattr(value, 'endDate', None)
+        return bool(endDate) and endDate < now
+
+    def expire(self, force=False):
+        """Drops listings that are too old or whose auction has ended, returns how many were dropped"""
+        if not force and self.now() - self.last_expired < self.expire_interval:
+            return 0
+        self.last_expired = self.now()
+        expired = [key for key in self._data if self._expired(key)]
+        for key in expired:
+            del self._data[key]
+        self.expirations += len(expired)
+        return len(expired)
+
+    def stats(self):
+        return {
+            'size' : len(self._data),
+            'seen' : len(self.seen_ids),
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+            'expirations' : self.expirations,
+        }
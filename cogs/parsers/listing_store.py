@@ -0,0 +1,195 @@
+import json
+
+from asyncio import create_task, get_running_loop, shield
+from concurrent.futures import ThreadPoolExecutor
+from os import listdir, makedirs, path, remove, replace
+from time import time
+
+
+class ListingStore:
+    """
+    Append-only listing log split into JSONL segments, one `[id, written_at, listing]` record per line.
+    Only new or updated listings are written, an in-memory index keeps the offset of the latest record
+    of every listing. Sealed segments that are mostly superseded or outdated get compacted in the background.
+    All file work runs on a single worker thread, so it never blocks the event loop and never interleaves.
+    The worker only reports offsets back, the index and segment counters are only touched on the loop.
+    """
+    def __init__(self, directory, logger, segment_size=8*1024*1024, compact_ratio=0.5, max_age=None):
+        self.directory = directory
+        self.logger = logger
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.max_age = max_age
+        self.index = {} # id : (segment, offset, written_at)
+        self.records = {} # segment : records written
+        self.live = {} # segment : records still referenced by index
+        self.newest = {} # segment : written_at of its latest record
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='listing_store')
+        self._compaction = None
+        makedirs(directory, exist_ok=True)
+
+    def segment_path(self, segment):
+        return path.join(self.directory, f'{segment:08d}.jsonl')
+
+    @property
+    def active_segment(self):
+        return max(self.records) if self.records else 1
+
+    def load(self):
+        """Reads every segment once, latest record of a listing wins. Returns {id : listing} oldest first"""
+        listings = {}
+        segments = sorted(int(x.split('.')[0]) for x in listdir(self.directory) if x.endswith('.jsonl'))
+        for segment in segments:
+            self.records[segment] = 0
+            self.live[segment] = 0
+            with open(self.segment_path(segment), 'rb') as f:
+                offset = 0
+                for line in f:
+                    try:
+                        key, written_at, listing = json.loads(line)
+                    except ValueError: # Torn write at the end of a segment
+                        self.logger.warning(f'Skipping broken record in segment {segment} at {offset}')
+                        offset += len(line)
+                        continue
+                    self._index(key, segment, offset, written_at)
+                    listings.pop(key, None)
+                    listings[key] = listing
+                    offset += len(line)
+        self.logger.debug(f'Loaded {len(listings)} listings from {len(segments)} segments')
+        return listings
+
+    def _index(self, key, segment, offset, written_at):
+        previous = self.index.get(key)
+        if previous:
+            self.live[previous[0]] -= 1
+        self.index[key] = (segment, offset, written_at)
+        self.records[segment] = self.records.get(segment, 0) + 1
+        self.live[segment] = self.live.get(segment, 0) + 1
+        self.newest[segment] = max(self.newest.get(segment, 0), written_at)
+
+    async def get(self, key):
+        """Reads the latest stored version of a listing straight from its segment"""
+        if self._compaction:
+            await shield(self._compaction) # Records of compacted segments are about to move
+        if key not in self.index:
+            return None
+        segment, offset, _ = self.index[key]
+        return await get_running_loop().run_in_executor(self._executor, self._read, segment, offset)
+
+    def _read(self, segment, offset):
+        with open(self.segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())[2]
+
+    async def append(self, listings):
+        if listings:
+            written_at = int(time())
+            written = await get_running_loop().run_in_executor(self._executor, self._append, listings, self.active_segment, written_at)
+            for key, segment, offset in written:
+                self._index(key, segment, offset, written_at)
+            self.maybe_compact()
+
+    def _append(self, listings, segment, written_at):
+        written = []
+        f = open(self.segment_path(segment), 'ab')
+        try:
+            for key, listing in listings.items():
+                if f.tell() >= self.segment_size:
+                    f.close()
+                    segment += 1
+                    f = open(self.segment_path(segment), 'ab')
+                offset = f.tell()
+                f.write(json.dumps([key, written_at, listing], default=str).encode('utf8') + b'\n')
+                written.append((key, segment, offset))
+        finally:
+            f.close()
+        return written
+
+    def _compactable(self):
+        active = self.active_segment
+        cutoff = time() - self.max_age if self.max_age else 0
+        return [x for x in self.records if x != active and self.records[x] and (self.live[x] / self.records[x] < self.compact_ratio or self.newest[x] < cutoff)]
+
+    def maybe_compact(self):
+        if not self._compaction and self._compactable():
+            self._compaction = create_task(self.compact())
+
+    async def compact(self):
+        segments = sorted(self._compactable())
+        cutoff = time() - self.max_age if self.max_age else 0
+        try:
+            moved, expired = await get_running_loop().run_in_executor(self._executor, self._compact, segments, dict(self.index), cutoff)
+            self._compacted(segments, moved, expired)
+        except Exception as e:
+            self.logger.error(f'Compaction failed: {e!r}')
+        finally:
+            self._compaction = None
+
+    def _compact(self, segments, index, cutoff):
+        # Live records of sparse segments are rewritten into the newest of them,
+        # they are the latest version of their listing so load order stays correct.
+        # `index` is a snapshot, records appended meanwhile go to the active segment which is never compacted
+        target = segments[-1]
+        tmp_path = self.segment_path(target) + '.tmp'
+        moved = {} # id : (old segment, old offset, new offset, written_at)
+        expired = [] # (id, old segment, old offset)
+        with open(tmp_path, 'wb') as out:
+            for segment in segments:
+                with open(self.segment_path(segment), 'rb') as f:
+                    offset = 0
+                    for line in f:
+                        try:
+                            key, written_at, _ = json.loads(line)
+                        except ValueError:
+                            offset += len(line)
+                            continue
+                        if index.get(key, (None, None))[:2] == (segment, offset):
+                            if written_at >= cutoff:
+                                moved[key] = (segment, offset, out.tell(), written_at)
+                                out.write(line)
+                            else:
+                                expired.append((key, segment, offset))
+                        offset += len(line)
+        for segment in segments:
+            if segment != target:
+                remove(self.segment_path(segment))
+        if moved:
+            replace(tmp_path, self.segment_path(target))
+        else:
+            remove(tmp_path)
+            remove(self.segment_path(target))
+        return moved, expired
+
+    def _compacted(self, segments, moved, expired):
+        target = segments[-1]
+        for key, segment, offset in expired:
+            if self.index.get(key, (None, None))[:2] == (segment, offset):
+                del self.index[key]
+        for segment in segments:
+            del self.records[segment]
+            del self.live[segment]
+            del self.newest[segment]
+        if moved:
+            # Listings updated while compacting already point at the active segment, their moved copy is dead
+            live = 0
+            for key, (segment, offset, new_offset, written_at) in moved.items():
+                if self.index.get(key, (None, None))[:2] == (segment, offset):
+                    self.index[key] = (target, new_offset, written_at)
+                    live += 1
+            self.records[target] = len(moved)
+            self.live[target] = live
+            self.newest[target] = max(written_at for *_, written_at in moved.values())
+        self.logger.debug(f'Compacted {len(segments)} segments into {target}, kept {len(moved)} records, active segment {self.active_segment}')
+
+    def close(self):
+        """Waits for pending writes and stops the worker thread"""
+        if self._compaction:
+            self._compaction.cancel()
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            'listings' : len(self.index),
+            'segments' : len(self.records),
+            'records' : sum(self.records.values()),
+        }
@@ -0,0 +1,86 @@
+import heapq
+
+from asyncio import get_running_loop
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from itertools import count
+
+
+class Priority(IntEnum):
+    """Outbound request classes, lower goes first"""
+    BID = 0
+    TARGET = 1
+    INTERACTIVE = 2
+    POLLING = 3
+
+
+def reserves(config, cap=None):
+    """{'POLLING' : 4, ...} from the config to {Priority.POLLING : 4, ...}, capped so every class keeps one slot"""
+    reserved = {Priority[name] : value for name, value in (config or {}).items()}
+    return {k : min(v, cap - 1) for k, v in reserved.items()} if cap else reserved
+
+
+class PriorityGate:
+    """
+    Concurrency slots handed out by priority, in arrival order within a class. A class only starts
+    while more slots than its reserve are free, so higher classes always find one. Queued requests of
+    a higher class go ahead of every queued lower one. `limit` None lets everything through.
+    """
+    def __init__(self, limit, reserved=None):
+        self.limit = limit
+        self.reserved = reserves(reserved, limit)
+        self.active = 0
+        self._waiters = [] # (priority, arrival, future)
+        self._arrivals = count()
+
+    def _free(self, priority):
+        return self.limit - self.active > self.reserved.get(priority, 0)
+
+    async def acquire(self, priority):
+        if self.limit is None:
+            return
+        if not self._waiters and self._free(priority):
+            self.active += 1
+            return
+        future = get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._arrivals), future))
+        self._wake()
+        try:
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                self.release() # Granted right as it got cancelled
+            raise
+
+    def release(self):
+        if self.limit is None:
+            return
+        self.active -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if not self._free(priority):
+                return
+            heapq.heappop(self._waiters)
+            self.active += 1
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, priority):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        waiting = {}
+        for priority, _, future in self._waiters:
+            if not future.done():
+                waiting[priority.name.lower()] = waiting.get(priority.name.lower(), 0) + 1
+        return {'active' : self.active, 'limit' : self.limit, 'waiting' : waiting}
@@ -0,0 +1,138 @@
+import heapq
+
+from asyncio import Event, Lock, sleep
+from email.utils import parsedate_to_datetime
+from itertools import count
+from time import monotonic, time
+from urllib.parse import urlsplit
+from cogs.parsers.priority import Priority, reserves
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average and up to `burst` at once, waiters are served in order"""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, which is either delay-seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter(TokenBucket):
+    """
+    Token bucket that backs off on its own: rate is halved on 429 and 5xx responses and on connection errors,
+    Retry-After pauses all requests for the given time, successful responses slowly bring the rate back up.
+    Waiters are served by priority, and a class only takes a token while more than its reserve are left.
+    Bids skip the queue, pauses and backoff caused by the rest of the traffic, they are only kept apart
+    by the configured rate and still use up tokens for everybody else.
+    """
+    def __init__(self, rate, burst=1, min_rate=None, recovery=0.05, reserved=None):
+        super().__init__(rate, burst)
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.recovery = recovery
+        self.reserved = reserves(reserved, int(burst))
+        self.blocked_until = 0
+        self.throttled = 0
+        self._next_bid = 0
+        self._waiters = [] # [priority, arrival]
+        self._arrivals = count()
+        self._turn = Event()
+
+    async def acquire(self, priority=Priority.POLLING):
+        if priority == Priority.BID:
+            return await self._acquire_bid()
+        ticket = [priority, next(self._arrivals)]
+        heapq.heappush(self._waiters, ticket)
+        try:
+            while True:
+                if self._waiters[0] is not ticket:
+                    # Woken up whenever the head of the queue changes
+                    turn = self._turn
+                    await turn.wait()
+                    continue
+                delay = self.blocked_until - monotonic()
+                if delay > 0:
+                    await sleep(delay)
+                    continue
+                self._refill()
+                needed = 1 + self.reserved.get(priority, 0)
+                if self.tokens >= needed:
+                    self.tokens -= 1
+                    return
+                # A higher class arriving meanwhile takes over the head and doesn't wait for this sleep
+                await sleep((needed - self.tokens) / self.rate)
+        finally:
+            self._waiters.remove(ticket)
+            heapq.heapify(self._waiters)
+            self._turn.set()
+            self._turn = Event()
+
+    async def _acquire_bid(self):
+        now = monotonic()
+        at = max(now, self._next_bid)
+        self._next_bid = at + 1 / self.max_rate
+        if at > now:
+            await sleep(at - now)
+        self._refill()
+        self.tokens -= 1
+
+    def feedback(self, status, retry_after=None):
+        if status == 429 or status >= 500:
+            self.slow_down(parse_retry_after(retry_after))
+        elif status < 400 and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.recovery)
+
+    def slow_down(self, pause=None):
+        self._refill()
+        self.throttled += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+        if pause:
+            self.blocked_until = max(self.blocked_until, monotonic() + pause)
+
+
+class HostLimiters:
+    """One AdaptiveLimiter per upstream host, budgets come from {host : (rate, burst)}"""
+    def __init__(self, limits, default=(5, 5), reserved=None):
+        self.limits = limits
+        self.default = default
+        self.reserved = reserved # {priority name : tokens kept for higher classes}
+        self.limiters = {}
+
+    def for_url(self, url):
+        host = urlsplit(str(url)).hostname or ''
+        if host not in self.limiters:
+            rate, burst = self.limits.get(host, self.default)
+            self.limiters[host] = AdaptiveLimiter(rate, burst, reserved=self.reserved)
+        return self.limiters[host]
+
+    def stats(self):
+        return {host : {'rate' : round(x.rate, 2), 'max_rate' : x.max_rate, 'throttled' : x.throttled} for host, x in self.limiters.items()}
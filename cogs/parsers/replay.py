@@ -0,0 +1,157 @@
+import asyncio
+import json
+
+from base64 import b64decode, b64encode
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from logging import getLogger
+from os import path
+from time import monotonic, time
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
+from multidict import CIMultiDict, CIMultiDictProxy
+
+logger = getLogger('market_bot.replay')
+
+
+def request_key(method, url, params=None, json_body=None, data=None):
+    """Identifies a request independent of parameter order, headers are left out since they carry random ids"""
+    parts = urlsplit(str(url))
+    query = parse_qsl(parts.query, keep_blank_values=True) + [(str(k), str(v)) for k, v in (params or {}).items()]
+    body = json.dumps(json_body, sort_keys=True) if json_body is not None else (str(data) if data is not None else None)
+    return json.dumps([method.upper(), urlunsplit((parts.scheme, parts.netloc, parts.path, '', '')), sorted(query), body])
+
+
+def encode_body(body):
+    try:
+        return {'text' : body.decode('utf8')}
+    except UnicodeDecodeError:
+        return {'base64' : b64encode(body).decode('ascii')}
+
+
+def decode_body(record):
+    if 'base64' in record:
+        return b64decode(record['base64'])
+    return record.get('text', '').encode('utf8')
+
+
+class RecordingSession:
+    """
+    Passes requests through to `session` and appends every exchange to a JSONL file,
+    which ReplaySession can serve later without network.
+    """
+    def __init__(self, session, filepath):
+        self.session = session
+        self.filepath = filepath
+        self.file = open(filepath, 'a', encoding='utf8')
+        self.recorded = 0
+
+    def pool_stats(self):
+        return self.session.pool_stats() if hasattr(self.session, 'pool_stats') else {}
+
+    def add_clock(self, host, clock):
+        if hasattr(self.session, 'add_clock'):
+            self.session.add_clock(host, clock)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    @asynccontextmanager
+    async def request(self, method, url, **kwargs):
+        started = monotonic()
+        async with self.session.request(method, url, **kwargs) as resp:
+            body = await resp.read() # Cached by aiohttp, the caller can still read the response
+            headers = {k : v for k, v in resp.headers.items() if k.lower() != 'set-cookie'}
+            self.write({
+                'key' : request_key(method, url, kwargs.get('params'), kwargs.get('json'), kwargs.get('data')),
+                'at' : time(),
+                'elapsed' : round(monotonic() - started, 4),
+                'status' : resp.status,
+                'headers' : headers,
+                **encode_body(body),
+            })
+            yield resp
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+        self.recorded += 1
+
+    def close(self):
+        self.file.close()
+
+
+class ReplayResponse:
+    def __init__(self, record, url):
+        self.status = record['status']
+        self.headers = CIMultiDictProxy(CIMultiDict(record.get('headers', {})))
+        self.url = url
+        self._body = decode_body(record)
+
+    async def read(self):
+        return self._body
+
+    async def text(self, encoding='utf8', **kwargs):
+        return self._body.decode(encoding)
+
+    async def json(self, loads=json.loads, **kwargs):
+        return loads(self._body)
+
+    def release(self):
+        pass
+
+
+class ReplaySession:
+    """
+    Serves recorded responses in the order they were recorded for each distinct request,
+    the last one is repeated once a request runs out of them. Unknown requests get 404,
+    a missing file is an empty recording. Every response waits for its recorded duration divided by `speed`, 0 answers immediately.
+    """
+    def __init__(self, filepath, speed=1.0):
+        self.filepath = filepath
+        self.speed = speed
+        self.responses = defaultdict(deque)
+        self.served = 0
+        self.missed = 0
+        if not path.isfile(filepath):
+            logger.warning(f'No recording at {filepath}, every request will get 404')
+            return
+        with open(filepath, 'r', encoding='utf8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.responses[record['key']].append(record)
+        logger.info(f'Loaded {sum(len(x) for x in self.responses.values())} recorded responses for {len(self.responses)} requests from {filepath}')
+
+    def pool_stats(self):
+        return {}
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def next_record(self, key):
+        queue = self.responses.get(key)
+        if not queue:
+            return None
+        return queue.popleft() if len(queue) > 1 else queue[0]
+
+    @asynccontextmanager
+    async def request(self, method, url, **kwargs):
+        record = self.next_record(request_key(method, url, kwargs.get('params'), kwargs.get('json'), kwargs.get('data')))
+        if record is None:
+            self.missed += 1
+            logger.warning(f'No recorded response for {method} {url}')
+            record = {'status' : 404, 'text' : ''}
+        else:
+            self.served += 1
+        if self.speed and record.get('elapsed'):
+            await asyncio.sleep(record['elapsed'] / self.speed)
+        yield ReplayResponse(record, url)
+
+    def close(self):
+        pass
@@ -0,0 +1,85 @@
+from typing import Any, Dict, List, TypedDict, Union
+
+# Typed views of marketplace responses for the fast decoding path.
+# Only declared fields are built, everything else in the payload is skipped while decoding.
+# Everything is total=False so a missing field fails later in the parser exactly like with plain dicts.
+
+Value = TypedDict('Value', {'value' : Any}, total=False)
+
+# Kleinanzeigen
+KleinanzeigenAd = TypedDict('KleinanzeigenAd', {
+    'id' : Any,
+    'title' : Value,
+    'price' : Any,
+    'locations' : Any,
+    'ad-address' : Any,
+    'search-distance' : Any,
+    'ad-status' : Any,
+    'start-date-time' : Value,
+    'attributes' : Any,
+    'displayoptions' : Any,
+    'link' : Any,
+    'pictures' : Any,
+}, total=False)
+
+KleinanzeigenAds = TypedDict('KleinanzeigenAds', {'ad' : List[KleinanzeigenAd]}, total=False)
+
+KleinanzeigenSearch = TypedDict('KleinanzeigenSearch', {
+    'searchOptions' : Any,
+    '{http://www.ebayclassifiedsgroup.com/schema/ad/v1}ads' : TypedDict('KleinanzeigenAdsValue', {'value' : KleinanzeigenAds}, total=False),
+}, total=False)
+
+KleinanzeigenAdDetails = TypedDict('KleinanzeigenAdDetails', {
+    'id' : Any,
+    'description' : Value,
+    'contact-name' : Value,
+    'user-id' : Value,
+    'user-rating' : Any,
+    'userBadges' : Any,
+    'user-since-date-time' : Value,
+}, total=False)
+
+KleinanzeigenDetails = TypedDict('KleinanzeigenDetails', {
+    '{http://www.ebayclassifiedsgroup.com/schema/ad/v1}ad' : TypedDict('KleinanzeigenAdValue', {'value' : KleinanzeigenAdDetails}, total=False),
+}, total=False)
+
+# eBay, search modules other than listings only keep the declared fields they happen to share
+EbayTracking = TypedDict('EbayTracking', {'eventProperty' : Dict[str, Any]}, total=False)
+
+EbaySearchItem = TypedDict('EbaySearchItem', {
+    'listingId' : Any,
+    'action' : TypedDict('EbayAction', {'trackingList' : List[EbayTracking]}, total=False),
+    'ended' : Any,
+    '__search' : TypedDict('EbaySearchInfo', {
+        'sellerInfo' : Any,
+        'normalizedCondition' : Any,
+        'sellerAccountType' : Any,
+    }, total=False),
+    'itemPropertyOrdering' : Any,
+    'logisticsCost' : Any,
+    'title' : Any,
+    'displayPrice' : Any,
+    'image' : Any,
+    'displayTime' : Any,
+}, total=False)
+
+# Module maps also carry plain strings, like `"_type": "Modules"`
+EbayModule = Union[str, EbaySearchItem]
+
+EbaySearch = TypedDict('EbaySearch', {
+    'modules' : Dict[str, EbayModule],
+    'deferred_modules' : List[Dict[str, EbayModule]],
+}, total=False)
+
+EbayDetails = TypedDict('EbayDetails', {
+    'modules' : TypedDict('EbayDetailsModules', {
+        'VLS' : TypedDict('EbayVLS', {
+            'listing' : TypedDict('EbayListing', {
+                'listingLifecycle' : Any,
+                'format' : Any,
+                'title' : Any,
+            }, total=False),
+        }, total=False),
+        'SEMANTIC_DATA' : TypedDict('EbaySemanticData', {'bidPrefetch' : Any}, total=False),
+    }, total=False),
+}, total=False)
@@ -0,0 +1,104 @@
+import sqlite3
+
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+
+class SeenIndex:
+    """
+    Disk-backed set of listing ids already seen on a marketplace, kept in SQLite.
+    Lookups go to the primary key on the loop, a point read from the page cache that stays
+    in the microseconds however large the table gets. Additions are buffered and written by `flush`
+    on a worker thread with its own connection, which also stores when the marketplace was last polled
+    so a restart can resume from there.
+    """
+    def __init__(self, filepath, marketplace, max_age=None):
+        self.filepath = filepath
+        self.marketplace = marketplace
+        self.max_age = max_age
+        self.db = sqlite3.connect(filepath)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS seen (marketplace TEXT, id TEXT, seen_at INTEGER, PRIMARY KEY (marketplace, id)) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (marketplace TEXT, key TEXT, value, PRIMARY KEY (marketplace, key)) WITHOUT ROWID')
+        self.db.commit()
+        self.count = self.db.execute('SELECT COUNT(*) FROM seen WHERE marketplace = ?', (marketplace,)).fetchone()[0]
+        self._pending = {}
+        self._flushing = [] # batches handed to the writer, still seen until committed
+        self._writer = None # connection owned by the worker thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='seen_index')
+        self.last_pruned = 0
+
+    def __contains__(self, key):
+        key = str(key)
+        if key in self._pending or any(key in batch for batch in self._flushing):
+            return True
+        return self.db.execute('SELECT 1 FROM seen WHERE marketplace = ? AND id = ?', (self.marketplace, key)).fetchone() is not None
+
+    def __len__(self):
+        # Approximate, ids already stored that are added again count until the next flush
+        return self.count + len(self._pending) + sum(len(batch) for batch in self._flushing)
+
+    def add(self, key):
+        self._pending.setdefault(str(key), int(time()))
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE marketplace = ? AND key = ?', (self.marketplace, key)).fetchone()
+        return row[0] if row else default
+
+    def last_polled(self):
+        """Timestamp of the last poll that was fully recorded, None on the very first run"""
+        return self.get_meta('last_polled')
+
+    def _take(self, polled_at):
+        batch, self._pending = self._pending, {}
+        prune_before = None
+        if self.max_age and time() - self.last_pruned > 60*60:
+            prune_before = int(time() - self.max_age)
+            self.last_pruned = time()
+        return batch, polled_at, prune_before
+
+    async def flush(self, polled_at=None):
+        """
+        Writes buffered ids. `polled_at` should be the moment the recorded polls started,
+        everything published after it and not in the index will be treated as new after a restart
+        """
+        batch, polled_at, prune_before = self._take(int(polled_at or time()))
+        self._flushing.append(batch)
+        try:
+            added, pruned = await get_running_loop().run_in_executor(self._executor, self._write, batch, polled_at, prune_before)
+        except BaseException:
+            self._pending = {**batch, **self._pending} # Retried with the next flush
+            raise
+        finally:
+            self._flushing = [x for x in self._flushing if x is not batch]
+        self.count += added - pruned
+
+    def _write(self, batch, polled_at, prune_before):
+        if self._writer is None:
+            self._writer = sqlite3.connect(self.filepath)
+            self._writer.execute('PRAGMA synchronous=NORMAL')
+        added = pruned = 0
+        if batch:
+            added = self._writer.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?, ?)', [(self.marketplace, k, v) for k, v in batch.items()]).rowcount
+        if polled_at is not None:
+            self._writer.execute('INSERT OR REPLACE INTO meta VALUES (?, ?, ?)', (self.marketplace, 'last_polled', polled_at))
+        if prune_before:
+            pruned = self._writer.execute('DELETE FROM seen WHERE marketplace = ? AND seen_at < ?', (self.marketplace, prune_before)).rowcount
+        self._writer.commit()
+        return added, pruned
+
+    def _close_writer(self):
+        if self._writer:
+            self._writer.close()
+
+    def close(self):
+        """
+        Writes what is still buffered and waits for the worker. The last poll time is left as it is,
+        listings published since the last recorded poll started and not seen yet are still new after a restart
+        """
+        self._executor.submit(self._write, *self._take(None))
+        self._executor.submit(self._close_writer)
+        self._executor.shutdown(wait=True)
+        self.db.close()
@@ -0,0 +1,57 @@
+def normalize(value):
+    if isinstance(value, str):
+        return value.strip().lower()
+    if isinstance(value, (list, tuple, set)):
+        return tuple(sorted(str(normalize(x)) for x in value))
+    if isinstance(value, dict):
+        return query_key(value)
+    return value
+
+def query_key(params):
+    """Hashable key of search parameters, equal for searches that hit upstream with the same request"""
+    return tuple(sorted((str(k), normalize(v)) for k, v in params.items()))
+
+
+class SearchCoalescer:
+    """
+    Groups subscribers (threads) by normalized search parameters,
+    so every distinct search is sent upstream once and its results are fanned out to all subscribers.
+    """
+    def __init__(self):
+        self.groups = {} # key : {params, subscribers}
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        return iter(list(self.groups.keys()))
+
+    def subscribe(self, subscriber, params):
+        key = query_key(params)
+        group = self.groups.setdefault(key, {'params' : params, 'subscribers' : {}})
+        group['subscribers'][subscriber] = None
+        return key
+
+    def unsubscribe(self, subscriber):
+        """Removes subscriber from every group, returns keys of groups it was part of"""
+        left = []
+        for key, group in list(self.groups.items()):
+            if subscriber in group['subscribers']:
+                del group['subscribers'][subscriber]
+                left.append(key)
+                if not group['subscribers']:
+                    del self.groups[key]
+        return left
+
+    def params(self, key):
+        return self.groups[key]['params']
+
+    def subscribers(self, key):
+        group = self.groups.get(key, None)
+        return list(group['subscribers']) if group else []
+
+    def subscriptions(self):
+        return sum(len(group['subscribers']) for group in self.groups.values())
+
+    def saved_requests(self):
+        return self.subscriptions() - len(self.groups)
@@ -0,0 +1,86 @@
+from collections import defaultdict, deque
+from time import time
+from metrics import FRESHNESS
+
+# publish -> detected, detected -> sent and publish -> sent
+STAGES = ('detected', 'sent', 'total')
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class FreshnessTracker:
+    """
+    Sliding windows of announcement delays for one marketplace, per query and overall.
+    Listings need `detected_at` set by the parser, the publish time may be filled in
+    after the announcement with `published`.
+    """
+    def __init__(self, marketplace, window=60*60, max_samples=500):
+        self.marketplace = marketplace
+        self.window = window
+        self.max_samples = max_samples
+        self.samples = defaultdict(lambda: deque(maxlen=self.max_samples)) # (stage, query or None) : (at, delay)
+        self.last_reported = time()
+
+    def add(self, stage, query, delay, at):
+        delay = max(delay, 0) # Clocks of upstream and ours disagree a bit
+        self.samples[(stage, query)].append((at, delay))
+        self.samples[(stage, None)].append((at, delay))
+        FRESHNESS.observe(delay, marketplace=self.marketplace, stage=stage)
+
+    def sent(self, query, published_at, detected_at, sent_at=None):
+        sent_at = sent_at or time()
+        if detected_at:
+            self.add('sent', query, sent_at - detected_at, sent_at)
+        if published_at:
+            self.published(query, published_at, detected_at, sent_at)
+
+    def published(self, query, published_at, detected_at, sent_at):
+        if detected_at:
+            self.add('detected', query, detected_at - published_at, sent_at)
+        self.add('total', query, sent_at - published_at, sent_at)
+
+    def delays(self, stage, query=None):
+        samples = self.samples.get((stage, query))
+        if not samples:
+            return []
+        oldest = time() - self.window
+        while samples and samples[0][0] < oldest:
+            samples.popleft()
+        return [delay for _, delay in samples]
+
+    def percentiles(self, stage, query=None):
+        delays = self.delays(stage, query)
+        if not delays:
+            return None
+        return {'count' : len(delays), 'p50' : percentile(delays, 0.5), 'p95' : percentile(delays, 0.95), 'p99' : percentile(delays, 0.99)}
+
+    def queries(self):
+        return {query for _, query in self.samples if query is not None}
+
+    def slow_queries(self, threshold, stage='total', limit=5):
+        """Queries whose p95 delay is above `threshold` seconds, slowest first"""
+        slow = []
+        for query in self.queries():
+            stats = self.percentiles(stage, query)
+            if stats and stats['p95'] > threshold:
+                slow.append((query, stats))
+        return sorted(slow, key=lambda x: x[1]['p95'], reverse=True)[:limit]
+
+    def summary(self):
+        parts = []
+        for stage in STAGES:
+            stats = self.percentiles(stage)
+            if stats:
+                parts.append(f"{stage} p50 {stats['p50']:.0f}s p95 {stats['p95']:.0f}s p99 {stats['p99']:.0f}s")
+        return ', '.join(parts) or 'no announcements yet'
+
+    def maybe_report(self, logger, threshold, interval=10*60):
+        if time() - self.last_reported < interval:
+            return
+        self.last_reported = time()
+        logger.info(f'Freshness: {self.summary()}')
+        for query, stats in self.slow_queries(threshold):
+            logger.warning(f"Slow query `{query}`: publish to announce p95 {stats['p95']:.0f}s over {stats['count']} listings")
@@ -0,0 +1,95 @@
+from cogs.utils.coalescing import query_key
+from cogs.parsers.listing import parse_price
+
+
+class SearchPlanner:
+    """
+    Merges coalesced searches that only differ in their price window and exclude filter
+    into one request covering their overlapping windows. Every entry's own window and exclude
+    are then applied client-side with `accepts`.
+    """
+    def __init__(self, min_key, max_key, exclude_key=None):
+        self.min_key = min_key
+        self.max_key = max_key
+        self.exclude_key = exclude_key
+        self.window_keys = {min_key, max_key, exclude_key}
+
+    def base_key(self, params):
+        return query_key({k: v for k, v in params.items() if k not in self.window_keys})
+
+    def window(self, params):
+        # Missing or zero bound means the side is open, same as in the search params builders
+        low = params.get(self.min_key) or None
+        high = params.get(self.max_key) or None
+        exclude = params.get(self.exclude_key, '') if self.exclude_key else ''
+        return low, high, (exclude or '').lower()
+
+    def accepts(self, window, price, title):
+        low, high, exclude = window
+        if exclude and exclude in title.lower():
+            return False
+        price = parse_price(price)
+        if price is None: # Can't tell, let the thread decide
+            return True
+        return (low is None or price >= float(low)) and (high is None or price <= float(high))
+
+    def plan(self, searches, keys=None):
+        """
+        Returns list of plans {params, entries: [(key, window)]} for coalesced search keys.
+        Only windows that overlap or touch are merged, one result page has to cover all of them
+        and a gap between them would only crowd out wanted listings. Open bounds are dropped from
+        merged params, the exclude filter is kept server-side when every entry has the same one.
+        """
+        groups = {}
+        for key in (keys if keys is not None else searches):
+            params = searches.params(key)
+            groups.setdefault(self.base_key(params), []).append((key, params))
+        plans = []
+        for group in groups.values():
+            group.sort(key=lambda x: self._low(self.window(x[1])))
+            clusters = []
+            for key, params in group:
+                window = self.window(params)
+                if clusters and self._touches(clusters[-1]['high'], window[0]):
+                    cluster = clusters[-1]
+                    cluster['high'] = self._max_high(cluster['high'], window[1])
+                else:
+                    cluster = {'high' : window[1], 'members' : []}
+                    clusters.append(cluster)
+                cluster['members'].append((key, params, window))
+            plans.extend(self._make_plan(cluster['members']) for cluster in clusters)
+        return plans
+
+    @staticmethod
+    def _low(window):
+        return float('-inf') if window[0] is None else float(window[0])
+
+    @staticmethod
+    def _touches(high, low):
+        return high is None or low is None or float(low) <= float(high)
+
+    @staticmethod
+    def _max_high(a, b):
+        return None if a is None or b is None else max(a, b, key=float)
+
+    def _make_plan(self, members):
+        params = {k: v for k, v in members[0][1].items() if k not in self.window_keys}
+        lows = [window[0] for _, _, window in members]
+        highs = [window[1] for _, _, window in members]
+        if None not in lows:
+            params[self.min_key] = min(lows, key=float)
+        if None not in highs:
+            params[self.max_key] = max(highs, key=float)
+        if self.exclude_key:
+            excludes = {entry_params.get(self.exclude_key) or '' for _, entry_params, _ in members}
+            if len(excludes) == 1:
+                params[self.exclude_key] = excludes.pop()
+        entries = [(key, window) for key, _, window in members]
+        return {
+            'params' : params,
+            'entries' : entries,
+            'match' : lambda price, title, entries=entries: any(self.accepts(window, price, title) for _, window in entries),
+        }
+
+    def matching(self, window, listings, new_ads):
+        return [ad_id for ad_id in new_ads if self.accepts(window, *listings(ad_id))]
@@ -0,0 +1,23 @@
+from asyncio import Semaphore, CancelledError
+
+
+class BoundedPoller:
+    """
+    Runs marketplace requests concurrently while keeping at most `limit` of them in flight.
+    Jobs are plain coroutines, failures are logged and replaced with `default` so one broken
+    query can't take the rest of the cycle down with it.
+    """
+    def __init__(self, limit, logger):
+        self.limit = limit
+        self.semaphore = Semaphore(limit)
+        self.logger = logger
+
+    async def limited(self, coro, default=None):
+        async with self.semaphore:
+            try:
+                return await coro
+            except CancelledError:
+                raise
+            except Exception:
+                self.logger.exception('Error during update')
+                return default
@@ -0,0 +1,120 @@
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import tracemalloc
+
+from asyncio import Lock, sleep, to_thread
+from collections import Counter
+from os import makedirs, path
+from time import strftime
+
+
+class Profiler:
+    """
+    On-demand CPU and memory profiling of the running bot, reports are written to `directory`.
+    Nothing is hooked in while idle, tracemalloc only runs between `memory_start` and `memory_stop`.
+    """
+    def __init__(self, directory, top=15):
+        self.directory = directory
+        self.top = top
+        self.lock = Lock()
+        self.baseline = None
+
+    def report_path(self, name, extension):
+        makedirs(self.directory, exist_ok=True)
+        return path.join(self.directory, f"{name}-{strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+    async def cprofile(self, seconds):
+        """Deterministic profile of everything the event loop runs for `seconds`, returns (summary, report path)"""
+        async with self.lock:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                await sleep(seconds)
+            finally:
+                profile.disable()
+            filepath = self.report_path('cprofile', 'txt')
+            profile.dump_stats(filepath.replace('.txt', '.prof'))
+            with open(filepath, 'w', encoding='utf8') as f:
+                pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats(100)
+            out = io.StringIO()
+            pstats.Stats(profile, stream=out).sort_stats('tottime').print_stats(self.top)
+            lines = [x for x in out.getvalue().splitlines() if x.strip()]
+            return '\n'.join(lines[-self.top-1:]), filepath
+
+    async def sample(self, seconds, interval=0.005):
+        """
+        Sampling profile of the event loop thread taken from a helper thread, cheap enough for production.
+        Writes collapsed stacks (flamegraph format), returns (summary, report path)
+        """
+        async with self.lock:
+            target = threading.get_ident()
+            stacks = Counter()
+            done = threading.Event()
+
+            def sampler():
+                while not done.wait(interval):
+                    frame = sys._current_frames().get(target)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f'{code.co_name} ({path.basename(code.co_filename)}:{frame.f_lineno})')
+                        frame = frame.f_back
+                    stacks[';'.join(reversed(stack))] += 1
+
+            thread = threading.Thread(target=sampler, name='profiler-sampler', daemon=True)
+            thread.start()
+            try:
+                await sleep(seconds)
+            finally:
+                done.set()
+                thread.join()
+            filepath = self.report_path('samples', 'txt')
+            with open(filepath, 'w', encoding='utf8') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+            total = sum(stacks.values()) or 1
+            leaves = Counter()
+            for stack, count in stacks.items():
+                leaves[stack.rsplit(';', 1)[-1]] += count
+            lines = [f'{count / total:6.1%} {leaf}' for leaf, count in leaves.most_common(self.top)]
+            return f'{total} samples, top frames:\n' + '\n'.join(lines), filepath
+
+    async def memory_start(self, frames=10):
+        async with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self.baseline = await to_thread(tracemalloc.take_snapshot)
+
+    async def memory_snapshot(self):
+        """
+        Diff against the previous snapshot by allocation site, returns (summary, report path).
+        Runs on a helper thread, copying the traces still holds the GIL and pauses the loop for a moment.
+        """
+        if not tracemalloc.is_tracing():
+            return 'Not tracing allocations, start tracing first', None
+        async with self.lock:
+            return await to_thread(self._memory_snapshot)
+
+    def _memory_snapshot(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        stats = snapshot.compare_to(self.baseline, 'lineno')
+        self.baseline = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        filepath = self.report_path('tracemalloc', 'txt')
+        with open(filepath, 'w', encoding='utf8') as f:
+            f.write(f'Traced {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB\n')
+            for stat in stats[:100]:
+                f.write(f'{stat}\n')
+        lines = [f'{stat.size_diff / 1024:+9.1f} KiB {stat.count_diff:+7} blocks {stat.traceback[0]}' for stat in stats[:self.top]]
+        return f'Traced {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB, top growth:\n' + '\n'.join(lines), filepath
+
+    def memory_stop(self):
+        self.baseline = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
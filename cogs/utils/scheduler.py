@@ -0,0 +1,95 @@
+import heapq
+
+from asyncio import Event, CancelledError, TimeoutError, create_task, wait_for
+from random import uniform
+from time import monotonic
+
+
+class QueryScheduler:
+    """
+    Timer heap for periodic queries. Every key has its own interval and jitter,
+    one long-running task pops due keys and dispatches them to `callback(key)`.
+    Next run is armed once the previous one has finished, so a slow query never overlaps itself.
+    """
+    def __init__(self, callback, logger):
+        self.callback = callback
+        self.logger = logger
+        self._heap = [] # (due, generation, key)
+        self._entries = {} # key : {interval, jitter, generation}
+        self._generation = 0
+        self._running = set()
+        self._tasks = set()
+        self._wakeup = Event()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, key, interval, jitter=0.5, delay=0):
+        # Rescheduling bumps the generation, stale heap entries are skipped on pop
+        self._generation += 1
+        self._entries[key] = {
+            'interval' : interval,
+            'jitter' : jitter,
+            'generation' : self._generation
+        }
+        if key not in self._running:
+            self._push(key, monotonic() + delay)
+
+    def unschedule(self, key):
+        self._entries.pop(key, None)
+
+    def next_due(self, key):
+        """Seconds until key runs again, None if it is not scheduled or is running right now"""
+        entry = self._entries.get(key)
+        if entry:
+            for due, generation, k in self._heap:
+                if k == key and generation == entry['generation']:
+                    return max(due - monotonic(), 0)
+        return None
+
+    def next_delay(self, entry):
+        return entry['interval'] * uniform(1 - entry['jitter'], 1 + entry['jitter'])
+
+    def _push(self, key, due):
+        heapq.heappush(self._heap, (due, self._entries[key]['generation'], key))
+        if self._heap[0][0] == due:
+            self._wakeup.set()
+
+    async def run(self):
+        try:
+            while True:
+                self._wakeup.clear()
+                now = monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    _, generation, key = heapq.heappop(self._heap)
+                    entry = self._entries.get(key)
+                    if not entry or entry['generation'] != generation:
+                        continue
+                    self._running.add(key)
+                    task = create_task(self._dispatch(key))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                timeout = self._heap[0][0] - now if self._heap else None
+                try:
+                    await wait_for(self._wakeup.wait(), timeout)
+                except TimeoutError:
+                    pass
+        finally:
+            for task in self._tasks:
+                task.cancel()
+
+    async def _dispatch(self, key):
+        try:
+            await self.callback(key)
+        except CancelledError:
+            raise
+        except Exception:
+            self.logger.exception(f'Error during scheduled update of {key}')
+        finally:
+            self._running.discard(key)
+            entry = self._entries.get(key)
+            if entry:
+                self._push(key, monotonic() + self.next_delay(entry))
@@ -0,0 +1,23 @@
+from asyncio import sleep
+from time import monotonic, time
+
+
+async def sleep_until(target_ts, spin=0.05, lock_in=5.0, max_chunk=30.0):
+    """
+    Sleeps until the wall clock timestamp `target_ts`, returns the monotonic deadline it aimed for.
+    While far away the remaining time is re-read from the wall clock every `max_chunk` seconds so clock
+    corrections are picked up, the last `lock_in` seconds only use the monotonic clock. Timers fire late
+    under load, so the final `spin` seconds are spent yielding to the loop with sleep(0) instead.
+    """
+    while True:
+        remaining = target_ts - time()
+        if remaining <= lock_in:
+            break
+        await sleep(min(remaining - lock_in, max_chunk))
+    deadline = monotonic() + target_ts - time()
+    coarse = deadline - spin - monotonic()
+    if coarse > 0:
+        await sleep(coarse)
+    while monotonic() < deadline:
+        await sleep(0)
+    return deadline
@@ -0,0 +1,180 @@
+import heapq
+import pickle
+
+from asyncio import Event, CancelledError, TimeoutError, create_task, current_task, wait_for
+from concurrent.futures import ThreadPoolExecutor
+from os import path, replace
+from time import time
+
+
+class TargetScheduler:
+    """
+    Armed bids in one heap ordered by target time, driven by a single task. A target only gets a task
+    of its own for the final approach, `lead` seconds before its time, where `callback(listing_id, target)`
+    takes over. Fired targets are disarmed. Every change is appended to a journal next to `filepath`,
+    which gets folded into the full pickle every `compact_every` records. `load` re-arms them.
+    All file work runs on one worker thread, in the order the changes were made.
+    """
+    def __init__(self, callback, logger, filepath, lead=60, max_sleep=30, compact_every=100):
+        self.callback = callback
+        self.logger = logger
+        self.filepath = filepath
+        self.journal_path = f'{filepath}.journal'
+        self.compact_every = compact_every
+        self.lead = lead
+        self.max_sleep = max_sleep # Target times are wall clock, re-checked at least this often
+        self.targets = {} # listing id : {targetTime, price, sid, infoMsgId, threadId, targetTitle}
+        self._heap = [] # (target time, generation, listing id)
+        self._generations = {} # listing id : generation of its live heap entry
+        self._generation = 0
+        self._running = {} # listing id : final approach task
+        self._wakeup = Event()
+        self._task = None
+        self._journal = None # append handle, only used on the worker thread
+        self._journaled = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='targets')
+
+    def __contains__(self, listing_id):
+        return listing_id in self.targets
+
+    def __getitem__(self, listing_id):
+        return self.targets[listing_id]
+
+    def __len__(self):
+        return len(self.targets)
+
+    def get(self, listing_id):
+        return self.targets.get(listing_id)
+
+    def items(self):
+        return list(self.targets.items())
+
+    def start(self):
+        self.load()
+        self._task = create_task(self.run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+        self.compact()
+        self._submit(self._close_journal)
+        self._executor.shutdown(wait=True)
+
+    def arm(self, listing_id, target, save=True):
+        self._generation += 1
+        self.targets[listing_id] = target
+        self._generations[listing_id] = self._generation
+        heapq.heappush(self._heap, (target['targetTime'], self._generation, listing_id))
+        if self._heap[0][2] == listing_id:
+            self._wakeup.set()
+        if save:
+            self.record('arm', listing_id, target)
+
+    def disarm(self, listing_id):
+        """Returns the removed target, a bid in its final approach is cancelled unless it disarms itself"""
+        target = self.targets.pop(listing_id, None)
+        self._generations.pop(listing_id, None)
+        task = self._running.pop(listing_id, None)
+        if task and task is not current_task():
+            task.cancel()
+        if target:
+            self.record('disarm', listing_id)
+        return target
+
+    def record(self, action, listing_id, target=None):
+        self._submit(self._append, pickle.dumps((action, listing_id, target)))
+        self._journaled += 1
+        if self._journaled >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        self._journaled = 0
+        self._submit(self._compact, {k : dict(v) for k, v in self.targets.items()})
+
+    def _submit(self, fn, *args):
+        self._executor.submit(fn, *args).add_done_callback(self._written)
+
+    def _written(self, future):
+        if future.exception():
+            self.logger.error(f'Failed to save targets: {future.exception()!r}')
+
+    def _append(self, data):
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'ab')
+        self._journal.write(data)
+        self._journal.flush()
+
+    def _compact(self, targets):
+        # Written next to the file first, a crash mid-write keeps the previous targets and journal.
+        # Records queued after this snapshot run after it and go to the fresh journal
+        with open(f'{self.filepath}.tmp', 'wb') as f:
+            pickle.dump(targets, f)
+        replace(f'{self.filepath}.tmp', self.filepath)
+        self._close_journal()
+        self._journal = open(self.journal_path, 'wb')
+
+    def _close_journal(self):
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+    def read(self):
+        targets = {}
+        if path.isfile(self.filepath):
+            with open(self.filepath, 'rb') as f:
+                targets = pickle.load(f)
+        if path.isfile(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                while True:
+                    try:
+                        action, listing_id, target = pickle.load(f)
+                    except EOFError:
+                        break
+                    except Exception: # Torn write at the end
+                        self.logger.warning('Skipping broken end of the targets journal')
+                        break
+                    if action == 'arm':
+                        targets[listing_id] = target
+                    else:
+                        targets.pop(listing_id, None)
+        return targets
+
+    def load(self):
+        now = time()
+        for listing_id, target in self.read().items():
+            if target['targetTime'] < now:
+                self.logger.warning(f'Target {listing_id} `{target.get("targetTitle")}` passed while stopped, dropped')
+                continue
+            self.arm(listing_id, target, save=False)
+        self.compact()
+        self.logger.info(f'Loaded {len(self.targets)} targets')
+
+    async def run(self):
+        try:
+            while True:
+                self._wakeup.clear()
+                now = time()
+                while self._heap and self._heap[0][0] - self.lead <= now:
+                    _, generation, listing_id = heapq.heappop(self._heap)
+                    if self._generations.get(listing_id) != generation:
+                        continue
+                    self._running[listing_id] = create_task(self._dispatch(listing_id, generation))
+                timeout = min(self._heap[0][0] - self.lead - now, self.max_sleep) if self._heap else None
+                try:
+                    await wait_for(self._wakeup.wait(), timeout)
+                except TimeoutError:
+                    pass
+        finally:
+            for task in self._running.values():
+                task.cancel()
+
+    async def _dispatch(self, listing_id, generation):
+        # Cancelled on shutdown the target stays saved for the next start
+        try:
+            await self.callback(listing_id, self.targets[listing_id])
+        except CancelledError:
+            raise
+        except Exception:
+            self.logger.exception(f'Error during bid on {listing_id}')
+        if self._generations.get(listing_id) == generation:
+            self.disarm(listing_id)
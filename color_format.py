@@ -17,7 +17,11 @@ class ColorFormatter(Formatter):
         CRITICAL: bold_red + format + reset
     }
 
+    def __init__(self):
+        super().__init__()
+        # One formatter per level, built once instead of for every record
+        self.formatters = {level: Formatter(fmt, self.dt_fmt, style='{') for level, fmt in self.FORMATS.items()}
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = Formatter(log_fmt, self.dt_fmt, style='{')
-        return formatter.format(record)
\ No newline at end of file
+        formatter = self.formatters.get(record.levelno) or self.formatters[INFO]
+        return formatter.format(record)
@@ -2,10 +2,10 @@ class Config:
     TOKEN = 'DISCORD_TOKEN'
     class BIG_EBAY_AUTH_TOKEN:
          # Rotates every 15 days
-        USER = 'EBAY_USER_TOKEN',
+        USER = 'EBAY_USER_TOKEN'
          # Rotates every 24 hours
-        ANON = 'EBAY_GUEST_TOKEN',
-        APP = 'EBAY_4APP_KEY',
+        ANON = 'EBAY_GUEST_TOKEN'
+        APP = 'EBAY_4APP_KEY'
         AUTH_DEBUG = 'EBAY_AUTH_DEBUG_KEY' # optional
     class SMOL_EBAY_KEYS:
         APP = 'KLEINANZEIGEN_4APP_KEY'
@@ -17,7 +17,81 @@ class Config:
         'BigEbayCommands' : 1234567890123456789
     }
     SMOL_EBAY_UPDATE_INTERVAL = 60
+    # Kleinanzeigen listing details and view counters, requests per second and burst
+    SMOL_EBAY_DETAIL_RATE = 1
+    SMOL_EBAY_DETAIL_BURST = 5
+    SMOL_EBAY_DETAIL_WORKERS = 4
     EBAY_UPDATE_INTERVAL = 120
+    # Client side budget per upstream host, (requests per second, burst). Halved automatically on 429/5xx
+    HOST_RATE_LIMITS = {
+        'api.kleinanzeigen.de' : (4, 8),
+        'apisd.ebay.com' : (4, 8)
+    }
+    # Decode responses with msgspec typed schemas or orjson when installed
+    FAST_JSON = True
+    # Requests are served bid > target > interactive > polling. A class only takes a token of the host
+    # budget or a pool connection while more than its reserve is left, keeping those for higher classes
+    REQUEST_RESERVED_TOKENS = {'TARGET' : 0, 'INTERACTIVE' : 1, 'POLLING' : 2}
+    REQUEST_RESERVED_CONNECTIONS = {'TARGET' : 1, 'INTERACTIVE' : 2, 'POLLING' : 4}
+    # Connection pool per marketplace, 'default' is used by everything else
+    HTTP_POOLS = {
+        'default' : {'limit' : 10, 'limit_per_host' : 5},
+        'SmolEbayCommands' : {'limit' : 20, 'limit_per_host' : 16, 'keepalive' : 60, 'dns_ttl' : 300, 'timeout' : 30, 'connect_timeout' : 10},
+        'BigEbayCommands' : {'limit' : 20, 'limit_per_host' : 16, 'keepalive' : 60, 'dns_ttl' : 300, 'timeout' : 30, 'connect_timeout' : 10},
+        # Only scheduled bids and their warm-up requests, so a bid never waits behind searches for a connection
+        'BigEbayBids' : {'limit' : 2, 'limit_per_host' : 2, 'keepalive' : 120, 'dns_ttl' : 600, 'timeout' : 10, 'connect_timeout' : 5},
+    }
+    # 'live', 'record' (live traffic is also written to HTTP_RECORD_PATH, one file per pool) or 'replay' (no network)
+    HTTP_MODE = 'live'
+    HTTP_RECORD_PATH = 'recordings'
+    # Replayed responses take their recorded time divided by this, 0 answers as fast as possible
+    HTTP_REPLAY_SPEED = 1.0
+    # Searches allowed in flight at once per marketplace
+    MAX_CONCURRENT_SEARCHES = {
+        'SmolEbayCommands' : 8,
+        'BigEbayCommands' : 4
+    }
     CACHE_PATH = 'cache'
+    # Publish to announce delays are kept for this long, queries slower than the threshold (p95) are logged
+    FRESHNESS_WINDOW = 60 * 60
+    FRESHNESS_SLOW_QUERY = 5 * 60
+    # eBay search results have no start date, it is fetched after announcing at this many requests per second, 0 disables
+    EBAY_START_DATE_RATE = 0.5
+    # Scheduled bids run on the monotonic clock for the last SNIPE_LOCK_IN seconds
+    # and spin on the event loop for the last SNIPE_SPIN seconds instead of trusting a timer
+    SNIPE_LOCK_IN = 5
+    SNIPE_SPIN = 0.05
+    # eBay's clock is estimated from Date headers of the last CLOCK_WINDOW seconds and refreshed
+    # CLOCK_SYNC_BEFORE seconds before every scheduled bid, bid times are corrected by the offset
+    CLOCK_WINDOW = 30 * 60
+    CLOCK_SYNC_BEFORE = 20
+    # The bid connection is opened BID_PREWARM_SECONDS before a scheduled bid and kept alive
+    # with a cheap request every BID_KEEPALIVE_INTERVAL seconds until shortly before it
+    BID_PREWARM_SECONDS = 60
+    BID_KEEPALIVE_INTERVAL = 10
+    # Prometheus text metrics on http://METRICS_HOST:METRICS_PORT/metrics, None disables the endpoint
+    METRICS_PORT = None
+    METRICS_HOST = '127.0.0.1'
+    # Listings kept in memory per marketplace, older ones are evicted but their ids are still remembered
+    LISTING_CACHE_SIZE = 20000
+    LISTING_CACHE_MAX_AGE = 7 * 24 * 60 * 60 # 7 days
+    # Seen listing ids are kept on disk for deduplication across restarts
+    LISTING_SEEN_MAX_AGE = 90 * 24 * 60 * 60 # 90 days
+    # Listings are appended to segment files in CACHE_PATH, sparse segments get compacted
+    LISTING_STORE_SEGMENT_SIZE = 8 * 1024 * 1024 # 8 MiB
+    LISTING_STORE_COMPACT_RATIO = 0.5
+    # Event loop lag is sampled every LOOP_MONITOR_INTERVAL seconds, callbacks blocking the loop
+    # for longer than LOOP_SLOW_CALLBACK seconds are recorded with their origin (None disables that)
+    LOOP_MONITOR_INTERVAL = 0.25
+    LOOP_SLOW_CALLBACK = 0.1
+    LOOP_REPORT_INTERVAL = 5 * 60
     LOG_FILE = 'logs/bot.log'
     LOG_SIZE = 32 * 1024 * 1024 # 32 MiB
+    # Writes one JSON object per line to LOG_FILE instead of plain text
+    LOG_JSON = False
+    # The same message from the same logger is written once per LOG_DUPLICATE_WINDOW seconds (0 writes all),
+    # longer messages get cut at LOG_MAX_MESSAGE characters
+    LOG_DUPLICATE_WINDOW = 60
+    LOG_MAX_MESSAGE = 4000
+    # Records waiting for the background writer, more are dropped instead of blocking the bot
+    LOG_QUEUE_SIZE = 10000
@@ -0,0 +1,111 @@
+import json
+import logging
+
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Full, Queue
+from time import monotonic, strftime, localtime
+from color_format import ColorFormatter
+from metrics import LOG_DROPPED
+
+FILE_FORMAT = '[{asctime}] [{levelname}] {name}: {message}'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers"""
+    def format(self, record):
+        entry = {
+            'time' : strftime(DATE_FORMAT, localtime(record.created)),
+            'level' : record.levelname,
+            'logger' : record.name,
+            'message' : record.getMessage(),
+            'where' : f'{record.filename}:{record.lineno}',
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DuplicateFilter(logging.Filter):
+    """
+    Lets the same message from the same logger through once per `window` seconds, the next one
+    after the window gets a count of what was dropped. Messages longer than `max_length` are cut.
+    Records with a traceback are also told apart by exception type and the frame that raised it.
+    """
+    def __init__(self, window=60, max_length=4000, max_keys=5000):
+        super().__init__()
+        self.window = window
+        self.max_length = max_length
+        self.max_keys = max_keys
+        self.seen = {} # (logger, level, message, exception) : [first seen, suppressed]
+
+    def filter(self, record):
+        message = record.getMessage()
+        if self.max_length and len(message) > self.max_length:
+            message = f'{message[:self.max_length]}... ({len(message)} chars)'
+        record.msg, record.args = message, None
+        if not self.window:
+            return True
+        key = (record.name, record.levelno, message, self.exception_key(record))
+        now = monotonic()
+        entry = self.seen.get(key)
+        if entry and now - entry[0] < self.window:
+            entry[1] += 1
+            LOG_DROPPED.inc(reason='duplicate')
+            return False
+        if entry and entry[1]:
+            record.msg = f'{message} (suppressed {entry[1]} identical messages)'
+        if len(self.seen) >= self.max_keys:
+            self.seen = {k: v for k, v in self.seen.items() if now - v[0] < self.window}
+            if len(self.seen) >= self.max_keys // 2:
+                self.seen.clear()
+        self.seen[key] = [now, 0]
+        return True
+
+    @staticmethod
+    def exception_key(record):
+        if not record.exc_info or not record.exc_info[0]:
+            return None
+        tb = record.exc_info[2]
+        while tb and tb.tb_next:
+            tb = tb.tb_next
+        return (record.exc_info[0], tb.tb_frame.f_code.co_filename, tb.tb_lineno) if tb else (record.exc_info[0],)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Never blocks the caller, records are dropped while the writer can't keep up"""
+    def prepare(self, record):
+        # Tracebacks are formatted by the listener thread, not by whoever logged them
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            LOG_DROPPED.inc(reason='queue_full')
+
+
+def setup_logging(logger, filename, max_bytes, json_lines=False, duplicate_window=60, max_length=4000, queue_size=10000):
+    """
+    Attaches a queue handler to `logger`, a background thread does the formatting of
+    tracebacks, console output and file writes and rotation. Returns the started listener.
+    """
+    file_handler = RotatingFileHandler(filename=filename, encoding='utf-8', maxBytes=max_bytes, backupCount=5)
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(FILE_FORMAT, DATE_FORMAT, style='{'))
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(ColorFormatter())
+
+    queue_handler = DroppingQueueHandler(Queue(queue_size))
+    queue_handler.setLevel(logging.INFO)
+    queue_handler.addFilter(DuplicateFilter(duplicate_window, max_length))
+    logger.addHandler(queue_handler)
+
+    listener = QueueListener(queue_handler.queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    return listener
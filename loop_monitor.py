@@ -0,0 +1,118 @@
+import asyncio
+
+from asyncio import events, tasks
+from collections import Counter, deque
+from time import monotonic, perf_counter
+from metrics import LOOP_LAG, SLOW_CALLBACKS
+
+
+def callback_origin(handle):
+    """Task steps are named after the task's coroutine and where it stopped, like asyncio debug mode does"""
+    callback = handle._callback
+    task = getattr(callback, '__self__', None)
+    if isinstance(task, tasks.Task):
+        coro = task.get_coro()
+        frame = getattr(coro, 'cr_frame', None)
+        where = f' at {frame.f_code.co_filename}:{frame.f_lineno}' if frame else ''
+        return f'{getattr(coro, "__qualname__", coro)}{where}'
+    callback = getattr(callback, '__func__', callback)
+    name = getattr(callback, '__qualname__', None)
+    return f'{callback.__module__}.{name}' if name and getattr(callback, '__module__', None) else repr(callback)
+
+
+class LoopMonitor:
+    """
+    Measures how late the event loop wakes up a sleeping task, and with `slow_callback` set
+    times every callback the loop runs, recording the ones that block it for longer.
+    """
+    def __init__(self, logger, interval=0.25, slow_callback=0.1, window=2400, report_interval=300):
+        self.logger = logger
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.report_interval = report_interval
+        self.lags = deque(maxlen=window)
+        self.slow = Counter() # origin : count
+        self.slow_time = Counter() # origin : seconds
+        self.worst = 0.0
+        self._original_run = None
+        self._task = None
+
+    def start(self):
+        if self.slow_callback:
+            self.patch()
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+        self.unpatch()
+
+    def patch(self):
+        if self._original_run:
+            return
+        original = self._original_run = events.Handle._run
+        monitor = self
+
+        def _run(handle):
+            started = perf_counter()
+            original(handle)
+            took = perf_counter() - started
+            if took > monitor.slow_callback:
+                monitor.record_slow(handle, took)
+        events.Handle._run = _run
+
+    def unpatch(self):
+        if self._original_run:
+            events.Handle._run = self._original_run
+            self._original_run = None
+
+    def record_slow(self, handle, took):
+        try:
+            origin = callback_origin(handle)
+        except Exception:
+            origin = 'unknown'
+        self.slow[origin] += 1
+        self.slow_time[origin] += took
+        self.worst = max(self.worst, took)
+        SLOW_CALLBACKS.inc()
+
+    async def run(self):
+        last_report = monotonic()
+        while True:
+            expected = monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(monotonic() - expected, 0)
+            self.lags.append(lag)
+            LOOP_LAG.observe(lag)
+            if monotonic() - last_report > self.report_interval:
+                last_report = monotonic()
+                self.report()
+
+    def percentiles(self):
+        if not self.lags:
+            return None
+        lags = sorted(self.lags)
+        pick = lambda q: lags[min(len(lags) - 1, int(q * len(lags)))]
+        return {'p50' : pick(0.5), 'p95' : pick(0.95), 'p99' : pick(0.99), 'max' : lags[-1]}
+
+    def top_slow(self, limit=5):
+        return [(origin, self.slow[origin], seconds) for origin, seconds in self.slow_time.most_common(limit)]
+
+    def summary(self):
+        stats = self.percentiles()
+        if not stats:
+            return 'no samples yet'
+        text = f"lag p50 {stats['p50']*1000:.1f}ms p95 {stats['p95']*1000:.1f}ms p99 {stats['p99']*1000:.1f}ms max {stats['max']*1000:.0f}ms"
+        if self.slow:
+            text += f', {sum(self.slow.values())} slow callbacks, worst {self.worst*1000:.0f}ms'
+        return text
+
+    def report(self):
+        stats = self.percentiles()
+        slow = self.slow_callback and stats and stats['p99'] > self.slow_callback
+        (self.logger.warning if slow else self.logger.info)(f'Event loop {self.summary()}')
+        for origin, count, seconds in self.top_slow():
+            self.logger.warning(f'Slow callback {origin}: {count}x, {seconds:.2f}s total')
+        self.slow.clear()
+        self.slow_time.clear()
+        self.worst = 0.0
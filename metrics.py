@@ -0,0 +1,198 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from aiohttp import web
+
+# Seconds, covers everything from parsing a small result to a slow upstream
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, '')) for name in labelnames)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, key)] + [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {} # label values : value
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, (), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for name, key, extra, value in self.samples():
+            lines.append(f'{name}{_format_labels(self.labelnames, key, extra)} {value}')
+        return lines
+
+    def total(self, **labels):
+        """Sum over every series matching the given labels"""
+        match = [(self.labelnames.index(k), str(v)) for k, v in labels.items()]
+        return sum(v for key, v in self.values.items() if all(key[i] == x for i, x in match))
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Either set directly or read from a function on every scrape"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        self.values[_label_key(self.labelnames, labels)] = value
+
+    def set_function(self, fn, **labels):
+        self.functions[_label_key(self.labelnames, labels)] = fn
+
+    def collect(self):
+        for key, fn in self.functions.items():
+            try:
+                self.values[key] = fn()
+            except Exception:
+                pass
+
+    def samples(self):
+        self.collect()
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = {'counts' : [0] * (len(self.buckets) + 1), 'sum' : 0.0, 'count' : 0}
+        series['counts'][bisect_left(self.buckets, value)] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series['counts']):
+                cumulative += count
+                yield f'{self.name}_bucket', key, (('le', bound),), cumulative
+            yield f'{self.name}_sum', key, (), series['sum']
+            yield f'{self.name}_count', key, (), series['count']
+
+    def merged(self, **labels):
+        match = [(self.labelnames.index(k), str(v)) for k, v in labels.items()]
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0
+        for key, series in self.values.items():
+            if all(key[i] == x for i, x in match):
+                counts = [a + b for a, b in zip(counts, series['counts'])]
+                total += series['count']
+        return counts, total
+
+    def quantile(self, q, **labels):
+        """Estimate interpolated within the bucket, None without observations"""
+        counts, total = self.merged(**labels)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for idx, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                low = self.buckets[idx - 1] if idx else 0
+                high = self.buckets[idx] if idx < len(self.buckets) else self.buckets[-1]
+                return low + (high - low) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def total(self, **labels):
+        return self.merged(**labels)[1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, help, labelnames, **kwargs)
+        return self.metrics[name]
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter('market_bot_http_requests_total', 'Upstream requests by endpoint and response status', ('host', 'endpoint', 'status'))
+REQUEST_QUEUE_TIME = REGISTRY.histogram('market_bot_request_queue_seconds', 'Time requests waited for host budget and a connection slot', ('host', 'priority'), buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+HTTP_LATENCY = REGISTRY.histogram('market_bot_http_request_seconds', 'Time from sending a request to its response headers', ('host', 'endpoint'))
+PARSE_DURATION = REGISTRY.histogram('market_bot_parse_seconds', 'Time spent parsing decoded responses', ('marketplace', 'kind'))
+LISTINGS_SEEN = REGISTRY.counter('market_bot_listings_seen_total', 'Listings returned by searches', ('marketplace', 'query'))
+LISTINGS_NEW = REGISTRY.counter('market_bot_listings_new_total', 'Listings not seen before', ('marketplace', 'query'))
+LISTINGS_ANNOUNCED = REGISTRY.counter('market_bot_listings_announced_total', 'Listings sent to threads', ('marketplace', 'query'))
+DISCORD_SEND_LATENCY = REGISTRY.histogram('market_bot_discord_send_seconds', 'Time to send one announcement to Discord', ('marketplace',))
+CYCLE_DURATION = REGISTRY.histogram('market_bot_cycle_seconds', 'Duration of one polling cycle, or of one scheduled search for eBay', ('marketplace',))
+FRESHNESS = REGISTRY.histogram('market_bot_freshness_seconds', 'Delay between publish, detection and announcement of listings', ('marketplace', 'stage'), buckets=(5, 10, 30, 60, 120, 300, 600, 1800, 3600, 4*3600))
+LOOP_LAG = REGISTRY.histogram('market_bot_loop_lag_seconds', 'How late the event loop woke up a sleeping task', buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+SLOW_CALLBACKS = REGISTRY.counter('market_bot_slow_callbacks_total', 'Event loop callbacks that ran longer than the slow callback threshold')
+LOG_DROPPED = REGISTRY.counter('market_bot_log_records_dropped_total', 'Log records suppressed as duplicates or dropped on a full queue', ('reason',))
+BID_SEND_OFFSET = REGISTRY.histogram('market_bot_bid_send_offset_seconds', 'Difference between planned and actual send time of scheduled bids', buckets=(0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+CLOCK_OFFSET = REGISTRY.gauge('market_bot_clock_offset_seconds', 'Estimated offset of upstream server clocks against ours', ('host',))
+CACHE_SIZE = REGISTRY.gauge('market_bot_cache_size', 'Entries in in-memory caches', ('marketplace', 'cache'))
+
+
+async def start_server(port, host='127.0.0.1'):
+    """Serves all metrics in Prometheus text format on /metrics, returns the runner to clean up"""
+    async def handle(request):
+        return web.Response(body=REGISTRY.render().encode('utf8'), headers={'Content-Type' : 'text/plain; version=0.0.4; charset=utf-8'})
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -3,43 +3,42 @@ import logging
 import asyncio
 
 from discord.ext import commands
-from typing import List, Optional
-from aiohttp import ClientSession
+from typing import Dict, List, Optional
+from contextlib import AsyncExitStack
 from config import Config
+from cogs.parsers.http import LimitedSession, PoolStats, make_session
+from cogs.parsers.rate_limit import HostLimiters
+from cogs.parsers.replay import RecordingSession, ReplaySession
+from metrics import start_server as start_metrics_server
+from loop_monitor import LoopMonitor
+from os import makedirs, path
 
 from traceback import format_exc
-from color_format import ColorFormatter
-from logging.handlers import RotatingFileHandler
+from log_pipeline import setup_logging
 
-# Logging setup
+# Logging setup, file and console are written by a background thread
 log = logging.getLogger("market_bot")
 log.setLevel(logging.DEBUG)
-
-fh = RotatingFileHandler(
-        filename=Config.LOG_FILE,
-        encoding='utf-8',
-        maxBytes=Config.LOG_SIZE,  
-        backupCount=5,  # Rotate through 5 files
+log_listener = setup_logging(
+        log,
+        Config.LOG_FILE,
+        Config.LOG_SIZE,
+        json_lines=Config.LOG_JSON,
+        duplicate_window=Config.LOG_DUPLICATE_WINDOW,
+        max_length=Config.LOG_MAX_MESSAGE,
+        queue_size=Config.LOG_QUEUE_SIZE,
 )
-fh.setLevel(logging.INFO)
-fh.setFormatter(logging.Formatter('[{asctime}] [{levelname}] {name}: {message}', '%Y-%m-%d %H:%M:%S', style='{'))
-
-# create console handler with a higher log level
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-ch.setFormatter(ColorFormatter())
-
-log.addHandler(fh)
-log.addHandler(ch)
 
 MY_GUILD_ID = 890577646998667275
 MY_GUILD = discord.Object(id=MY_GUILD_ID)  # replace with your guild id
 
 class Daikon(commands.Bot):
-    def __init__(self, *args, initial_exts: List[str], session:ClientSession, **kwargs):
+    def __init__(self, *args, initial_exts: List[str], sessions:Dict[str, LimitedSession], **kwargs):
         super().__init__(*args, **kwargs)
         self.initial_exts = initial_exts
-        self.session = session
+        self.sessions = sessions
+        self.session = sessions['default']
+        self.loop_monitor = None
 
     # In this basic example, we just synchronize the app commands to one guild.
     # Instead of specifying a guild to every command, we copy over our global commands instead.
@@ -51,7 +50,9 @@ class Daikon(commands.Bot):
 
         for cog_name, cog in self.cogs.items():
             log.info(f'Loaded {cog_name}')
-            cog._set_essentials(self.session)
+            cog._set_essentials(self.sessions.get(cog_name, self.session))
+            if hasattr(cog, 'set_bid_session') and callable(cog.set_bid_session):
+                cog.set_bid_session(self.sessions.get(f'{cog_name}Bids'))
 
         # This copies the global commands over to your guild.
         self.tree.copy_global_to(guild=MY_GUILD)
@@ -72,17 +73,45 @@ async def main():
     exts = ['cogs.ebay_commands', 'cogs.misc_commands', 'cogs.big_ebay_commands']
     intents = discord.Intents.default()
     intents.message_content = True
-    async with ClientSession(trust_env=True) as s:
+    async with AsyncExitStack() as stack:
+        monitor = LoopMonitor(logging.getLogger('market_bot.loop'), Config.LOOP_MONITOR_INTERVAL, Config.LOOP_SLOW_CALLBACK, report_interval=Config.LOOP_REPORT_INTERVAL)
+        monitor.start()
+        stack.callback(monitor.stop)
+        if Config.METRICS_PORT:
+            runner = await start_metrics_server(Config.METRICS_PORT, Config.METRICS_HOST)
+            stack.push_async_callback(runner.cleanup)
+            log.info(f'Serving metrics on http://{Config.METRICS_HOST}:{Config.METRICS_PORT}/metrics')
+        # Every marketplace gets its own connection pool, all parser requests go through the per host limiters
+        limiters = HostLimiters(Config.HOST_RATE_LIMITS, reserved=Config.REQUEST_RESERVED_TOKENS)
+        sessions = {}
+        if Config.HTTP_MODE != 'live':
+            makedirs(Config.HTTP_RECORD_PATH, exist_ok=True)
+        for name, pool_config in Config.HTTP_POOLS.items():
+            record_file = path.join(Config.HTTP_RECORD_PATH, f'{name}.jsonl')
+            if Config.HTTP_MODE == 'replay':
+                # Recorded traffic only, nothing goes to the network
+                sessions[name] = ReplaySession(record_file, Config.HTTP_REPLAY_SPEED)
+                continue
+            pool = PoolStats()
+            s = await stack.enter_async_context(make_session(pool, **pool_config))
+            sessions[name] = LimitedSession(s, limiters, pool, Config.REQUEST_RESERVED_CONNECTIONS)
+            if Config.HTTP_MODE == 'record':
+                sessions[name] = RecordingSession(sessions[name], record_file)
+                stack.callback(sessions[name].close)
         async with Daikon(
             commands.when_mentioned,
             initial_exts=exts,
-            session=s,
+            sessions=sessions,
             intents=intents
         ) as bot:
+            bot.loop_monitor = monitor
             await bot.start(Config.TOKEN)
 
 try:
     asyncio.run(main())
 except KeyboardInterrupt:
     print('Shutting down')
+finally:
+    # Flushes whatever is still queued
+    log_listener.stop()
     
\ No newline at end of file